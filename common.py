@@ -7,14 +7,16 @@ SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
 import collections.abc
+import csv
 import enum
+import io
 import json
 import re
 import traceback
 from datetime import datetime, timezone
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Union
+from typing import Iterable, Sequence, Union
 
 import aiohttp
 import httpx
@@ -210,6 +212,30 @@ def error_embed_factory(
     return embed
 
 
+def csv_file(filename: str, header: Iterable[str], rows: Iterable[Iterable]) -> discord.File:
+    """Writes rows to a CSV attachment, for results too many to show in an embed."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return discord.File(io.BytesIO(buffer.getvalue().encode()), filename)
+
+
+def join_lines(lines: Sequence[str], size: int) -> str:
+    """Joins as many lines as fit in `size` characters, and says how many didn't."""
+    shown: list[str] = []
+    total = 0
+    for line in lines:
+        # leave room for the note
+        if total + len(line) + 1 > size - 30:
+            break
+        shown.append(line)
+        total += len(line) + 1
+    if len(shown) < len(lines):
+        shown.append(f"*...and {len(lines) - len(shown)} more.*")
+    return "\n".join(shown)
+
+
 async def add_react(msg: discord.Message, react: Union[Emoji, PartialEmoji, str]):
     try:
         await msg.add_reaction(react)
@@ -6,10 +6,12 @@ Copyright (C) 2019-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
+import asyncio
 import inspect
+import os
 import random
 import re
-from typing import Iterable, Tuple, Union
+from typing import Iterable, Optional, Tuple, Union
 import pathlib
 
 import discord
@@ -72,14 +74,25 @@ class QrmHelpCommand(commands.HelpCommand):
             except CommandError:
                 return False
 
-        cmds = []
-        for cmd in iterator:
-            if await predicate(cmd):
-                cmds.append(cmd)
+        cmds = list(iterator)
+        allowed = await asyncio.gather(*(predicate(cmd) for cmd in cmds))
 
-        return sort_by_cat(cmds)
+        return sort_by_cat([cmd for cmd, ok in zip(cmds, allowed) if ok])
+
+    def _cache_entry(self) -> dict:
+        """The help cache entry for this kind of context.
+
+        The only checks in use depend on who is asking and where, so the owner and
+        guild/DM split is enough to tell apart what `verify_checks` would show."""
+        ctx = self.context
+        key = (ctx.author.id in opt.owners_uids, ctx.guild is not None, self.show_hidden)
+        return ctx.bot.qrm.help_cache.setdefault(key, {})
 
     async def get_bot_mapping(self):
+        entry = self._cache_entry()
+        if "mapping" in entry:
+            return entry["mapping"]
+
         bot = self.context.bot
         mapping = {}
 
@@ -89,6 +102,7 @@ class QrmHelpCommand(commands.HelpCommand):
                 mapping[cat].append(cmd)
             else:
                 mapping[cat] = [cmd]
+        entry["mapping"] = mapping
         return mapping
 
     async def get_command_signature(self, command):
@@ -125,14 +139,18 @@ class QrmHelpCommand(commands.HelpCommand):
             )
         mapping = await mapping
 
-        for cat, cmds in mapping.items():
-            if cmds == []:
-                continue
-            names = sorted([cmd.name for cmd in cmds])
-            if cat is not None:
-                embed.add_field(name=cat.value, value=", ".join(names), inline=False)
-            else:
-                embed.add_field(name="Other", value=", ".join(names), inline=False)
+        entry = self._cache_entry()
+        if "fields" not in entry:
+            fields = []
+            for cat, cmds in mapping.items():
+                if cmds == []:
+                    continue
+                names = sorted([cmd.name for cmd in cmds])
+                fields.append((cat.value if cat is not None else "Other", ", ".join(names)))
+            entry["fields"] = fields
+
+        for name, value in entry["fields"]:
+            embed.add_field(name=name, value=value, inline=False)
         await self.context.send(embed=embed)
 
     async def send_command_help(self, command):
@@ -166,7 +184,7 @@ class BaseCog(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.changelog = parse_changelog()
+        load_changelog(bot)
         commit_file = pathlib.Path("git_commit")
         dot_git = pathlib.Path(".git")
         if commit_file.is_file():
@@ -286,7 +304,10 @@ class BaseCog(commands.Cog):
     # region changelog
 
     async def _changelog_core(
-        self, ctx: Union[ApplicationContext, commands.Context], version: str = "latest"
+        self,
+        ctx: Union[ApplicationContext, commands.Context],
+        version: str = "latest",
+        page: int = 1,
     ) -> Embed:
         """Shows what has changed in a bot version. Defaults to the latest version."""
         embed = cmn.embed_factory(ctx)
@@ -295,9 +316,8 @@ class BaseCog(commands.Cog):
             "For a full listing, visit [GitHub](https://"
             "github.com/JayToTheAy/qrm3/blob/master/CHANGELOG.md)."
         )
-        changelog = self.changelog
-        vers = list(changelog.keys())
-        vers.remove("Unreleased")
+        changelog = load_changelog(self.bot)
+        vers = [v for v in changelog if v != "Unreleased"]
 
         version = version.lower()
 
@@ -315,11 +335,20 @@ class BaseCog(commands.Cog):
             embed.colour = cmn.colours.bad
             return embed
 
-        if "date" in log:
-            embed.description += f"\n\n**v{version}** ({log['date']})"
+        if not 1 <= page <= len(log.pages):
+            embed.title += ": Page Not Found"
+            embed.description += f"\n\n**v{version}** has {len(log.pages)} page(s)."
+            embed.colour = cmn.colours.bad
+            return embed
+
+        if log.date:
+            embed.description += f"\n\n**v{version}** ({log.date})"
         else:
             embed.description += f"\n\n**v{version}**"
-        embed = await format_changelog(log, embed)
+        if len(log.pages) > 1:
+            embed.description += f" — page {page}/{len(log.pages)}"
+        for name, value in log.pages[page - 1]:
+            embed.add_field(name=name, value=value, inline=False)
 
         return embed
 
@@ -330,14 +359,19 @@ class BaseCog(commands.Cog):
             IntegrationType.user_install,
         },
     )
-    async def _changelog_slash(self, ctx: ApplicationContext, version: str = "latest"):
+    async def _changelog_slash(
+        self, ctx: ApplicationContext, version: str = "latest", page: int = 1
+    ):
         """Shows what has changed in a bot version. Defaults to the latest version."""
-        await ctx.send_response(embed=await self._changelog_core(ctx, version))
+        await ctx.send_response(embed=await self._changelog_core(ctx, version, page))
 
     @commands.command(name="changelog", aliases=["clog"], category=cmn.BoltCats.INFO)
-    async def _changelog_prefix(self, ctx: commands.Context, version: str = "latest"):
-        """Shows what has changed in a bot version. Defaults to the latest version."""
-        await ctx.send(embed=await self._changelog_core(ctx, version))
+    async def _changelog_prefix(
+        self, ctx: commands.Context, version: str = "latest", page: int = 1
+    ):
+        """Shows what has changed in a bot version. Defaults to the latest version. \
+        Long changelogs are split into pages; give a page number after the version."""
+        await ctx.send(embed=await self._changelog_core(ctx, version, page))
 
     # endregion
 
@@ -424,41 +458,96 @@ class BaseCog(commands.Cog):
     # endregion
 
 
-def parse_changelog():
-    changelog = {}
+changelog_version_regex = re.compile(r"##[^#]")
+changelog_version_name_regex = re.compile(r"\[(.+)\](?: - )?(\d{4}-\d{2}-\d{2})?")
+changelog_heading_regex = re.compile(r"###[^#]")
+
+# Discord's embed limits, leaving room for the title, description and footer
+changelog_field_max = 1024
+changelog_page_max = 4500
+changelog_page_fields = 25
+
+
+class ChangelogVersion:
+    """One version's changes, already rendered into pages of embed fields.
+
+    `date` is None for undated versions, like Unreleased."""
+
+    __slots__ = ("date", "pages")
+
+    def __init__(self, date: Optional[str], sections: dict[str, list[str]]):
+        self.date = date
+        self.pages: list[list[tuple[str, str]]] = [[]]
+        size = 0
+        for field in render_changelog_fields(sections):
+            field_size = len(field[0]) + len(field[1])
+            page = self.pages[-1]
+            if page and (
+                size + field_size > changelog_page_max
+                or len(page) >= changelog_page_fields
+            ):
+                page = []
+                self.pages.append(page)
+                size = 0
+            page.append(field)
+            size += field_size
+
+
+def render_changelog_fields(sections: dict[str, list[str]]) -> list[tuple[str, str]]:
+    """Renders each section as embed fields, splitting sections too long for one field."""
+    fields = []
+    for header, lines in sections.items():
+        name = f"**{header}**"
+        formatted = ""
+        for line in lines:
+            entry = f"- {line}\n"
+            if len(entry) > changelog_field_max:
+                entry = entry[: changelog_field_max - 4] + "...\n"
+            if len(formatted) + len(entry) > changelog_field_max:
+                fields.append((name, formatted))
+                name = f"**{header}** (cont.)"
+                formatted = ""
+            formatted += entry
+        fields.append((name, formatted))
+    return fields
+
+
+def parse_changelog(path: str = "CHANGELOG.md") -> dict[str, ChangelogVersion]:
+    sections: dict[str, dict[str, list[str]]] = {}
+    dates: dict[str, str] = {}
     ver = ""
     heading = ""
 
-    with open("CHANGELOG.md") as changelog_file:
-        for line in changelog_file.readlines():
+    with open(path) as changelog_file:
+        for line in changelog_file:
             if line.strip() == "":
                 continue
-            if re.match(r"##[^#]", line):
-                ver_match = re.match(
-                    r"\[(.+)\](?: - )?(\d{4}-\d{2}-\d{2})?", line.lstrip("#").strip()
-                )
+            if changelog_version_regex.match(line):
+                ver_match = changelog_version_name_regex.match(line.lstrip("#").strip())
                 if ver_match is not None:
                     ver = ver_match.group(1)
-                    changelog[ver] = dict()
+                    sections[ver] = dict()
                     if ver_match.group(2):
-                        changelog[ver]["date"] = ver_match.group(2)
-            elif re.match(r"###[^#]", line):
+                        dates[ver] = ver_match.group(2)
+            elif changelog_heading_regex.match(line):
                 heading = line.lstrip("#").strip()
-                changelog[ver][heading] = []
+                sections[ver][heading] = []
             elif ver != "" and heading != "":
                 if line.startswith("-"):
-                    changelog[ver][heading].append(line.lstrip("-").strip())
-    return changelog
+                    sections[ver][heading].append(line.lstrip("-").strip())
+    return {ver: ChangelogVersion(dates.get(ver), log) for ver, log in sections.items()}
 
 
-async def format_changelog(log: dict, embed: discord.Embed):
-    for header, lines in log.items():
-        formatted = ""
-        if header != "date":
-            for line in lines:
-                formatted += f"- {line}\n"
-            embed.add_field(name=f"**{header}**", value=formatted, inline=False)
-    return embed
+def load_changelog(bot: commands.Bot, path: str = "CHANGELOG.md") -> dict[str, ChangelogVersion]:
+    """Returns the parsed changelog, only parsing it again when the file has changed.
+
+    Kept on `bot.qrm` so reloading this extension doesn't parse it again either."""
+    mtime = os.stat(path).st_mtime_ns
+    cached = bot.qrm.changelog
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, parse_changelog(path))
+        bot.qrm.changelog = cached
+    return cached[1]
 
 
 def setup(bot: commands.Bot):
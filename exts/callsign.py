@@ -7,40 +7,149 @@ Copyright (C) 2021-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
-from typing import Dict, Union
+import asyncio
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
 
-import aiohttp
-from callsignlookuptools import QrzAsyncClient, CallsignLookupError, CallsignData
-
-from discord import IntegrationType, ApplicationContext, Embed
-from discord.ext import commands
+import discord
+from discord import IntegrationType, ApplicationContext, Embed, File, Option
+from discord.ext import commands, tasks
 
 import common as cmn
+from utils.admission import SlidingWindowLimiter
+from utils.callsign_db import CallsignDB
+from utils.lazy import lazy_import
 
 import data.options as opt
 import data.keys as keys
 
 
+callsignlookuptools = lazy_import("callsignlookuptools")
+
+qrz_session_path = Path("data/qrz_session")
+
+max_bulk_calls = 100
+# How often the progress of a bulk lookup is shown, in seconds
+bulk_update_interval = 2.0
+call_split_regex = re.compile(r"[\s,;]+")
+
+# QRZ errors that mean the callsign doesn't exist, rather than that the lookup failed
+not_found_errors = ("Not found", "No data found", "Invalid Callsign")
+
+
+class LookupCache:
+    """Recent lookup results, by callsign, kept for `ttl` seconds (`negative_ttl` for misses).
+
+    Least recently used entries are dropped past `size`. The cache is saved to `path`
+    so it survives restarts; `save()` only writes when something changed."""
+
+    def __init__(self, path: Path, size: int = 5000, ttl: float = 86400, negative_ttl: float = 3600):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        # callsign: (expiry timestamp, result)
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        try:
+            with self.path.open() as file:
+                saved = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            saved = []
+        now = time.time()
+        for key, expires, result in saved:
+            if expires > now:
+                self._entries[key] = (expires, result)
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, result: dict) -> None:
+        ttl = self.negative_ttl if "error" in result else self.ttl
+        self._entries[key] = (time.time() + ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def save(self) -> None:
+        if self._dirty:
+            self._write(self._snapshot())
+
+    async def save_async(self) -> None:
+        """Like `save()`, but writes the file in a thread."""
+        if self._dirty:
+            await asyncio.to_thread(self._write, self._snapshot())
+
+    def _snapshot(self) -> list:
+        # taken on the event loop, so lookups can't change the entries mid-write
+        now = time.time()
+        self._dirty = False
+        return [[k, exp, res] for k, (exp, res) in self._entries.items() if exp > now]
+
+    def _write(self, entries: list) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            with tmp.open("w") as file:
+                json.dump(entries, file)
+            os.replace(tmp, self.path)
+        except BaseException:
+            self._dirty = True
+            raise
+
+
 class QRZCog(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.qrz = None
+        self.qrz_ready = False
+        self.session_key = ""
+        self.cache = LookupCache(cmn.paths.data / "qrz_cache.json")
+        self.limiter = SlidingWindowLimiter(opt.qrz_rate_limit, 1.0)
+        # imported FCC/ISED license dumps, see utils/callsign_db.py
+        self.local = CallsignDB(cmn.paths.data / "callsigns.sqlite3")
+        if not opt.lazy_imports:
+            self.setup_qrz()
+
+    def cog_unload(self):
+        self._save_cache.cancel()
+        self.cache.save()
+
+    @tasks.loop(minutes=10)
+    async def _save_cache(self):
+        await self.cache.save_async()
+
+    def setup_qrz(self):
+        """Creates the QRZ client if credentials are configured."""
+        self.qrz_ready = True
         try:
             if keys.qrz_user and keys.qrz_pass:
                 # seed the qrz object with the previous session key, in case it already works
-                session_key = ""
                 try:
-                    with open("data/qrz_session") as qrz_file:
-                        session_key = qrz_file.readline().strip()
+                    with qrz_session_path.open() as qrz_file:
+                        self.session_key = qrz_file.readline().strip()
                 except FileNotFoundError:
                     pass
-                self.qrz = QrzAsyncClient(
+                self.qrz = callsignlookuptools.QrzAsyncClient(
                     username=keys.qrz_user,
                     password=keys.qrz_pass,
                     useragent="discord-qrm3",
-                    session_key=session_key,
-                    session=aiohttp.ClientSession(connector=bot.qrm.connector),
+                    session_key=self.session_key,
+                    session=self.bot.qrm.http.session,
                 )
         except AttributeError:
             pass
@@ -52,34 +161,95 @@ class QRZCog(commands.Cog):
     ) -> Embed:
         """Builds an embed for a QRZ Lookup."""
 
+        if not self.qrz_ready:
+            self.setup_qrz()
+
         embed = cmn.embed_factory(ctx)
         embed.title = f"QRZ Data for {callsign.upper()}"
 
-        if self.qrz is None:
+        result = await self._lookup(callsign.upper())
+        if result is None:
             embed.colour = cmn.colours.neutral
             embed.add_field(
                 name="Link", value=f"http://qrz.com/db/{callsign}", inline=False
             )
             return embed
         else:
-            try:
-                data = await self.qrz.search(callsign)
-            except CallsignLookupError as e:
+            if "error" in result:
                 embed.colour = cmn.colours.bad
-                embed.description = str(e)
+                embed.description = result["error"]
                 return embed
+
+            if "source" in result:
+                embed.title = f"Callsign Data for {result['callsign']}"
+                embed.description = f"From the {result['source']} license database."
             else:
-                embed.title = f"QRZ Data for {data.callsign}"
-                embed.colour = cmn.colours.good
-                embed.url = data.url
-                if data.image is not None:
-                    embed.set_thumbnail(url=data.image.url)
+                embed.title = f"QRZ Data for {result['callsign']}"
+            embed.colour = cmn.colours.good
+            embed.url = result["url"]
+            if result["image"] is not None:
+                embed.set_thumbnail(url=result["image"])
 
-                for title, val in qrz_process_info(data).items():
-                    if val is not None and (val := str(val)):
-                        embed.add_field(name=title, value=val, inline=True)
+            for title, val in result["fields"]:
+                embed.add_field(name=title, value=val, inline=True)
 
-                return embed
+            return embed
+
+    async def _lookup(self, callsign: str) -> Optional[dict]:
+        """Looks up a callsign in the local license database, or on QRZ if it doesn't cover it.
+
+        Returns None if neither can look the callsign up."""
+        if self.local.sources:
+            result = await asyncio.to_thread(self.local.lookup, callsign)
+            if result is not None:
+                return result
+        if self.qrz is None:
+            return None
+        return await self._qrz_search(callsign)
+
+    async def _qrz_search(self, callsign: str) -> dict:
+        """Looks up a callsign on QRZ, or in the cache of recent lookups.
+
+        Results are kept in the form the embed needs, so they can be saved as JSON."""
+        result = self.cache.get(callsign)
+        if result is not None:
+            return result
+
+        async def search() -> dict:
+            # one limit for every lookup, so bulk lookups can't trip QRZ's own
+            while wait := self.limiter.hit("qrz"):
+                await asyncio.sleep(wait)
+            try:
+                data = await self.qrz.search(callsign)
+            except callsignlookuptools.CallsignLookupError as e:
+                result = {"error": str(e)}
+                if str(e).startswith(not_found_errors):
+                    self.cache.put(callsign, result)
+                return result
+            finally:
+                await self._save_session_key()
+            result = {
+                "callsign": str(data.callsign),
+                "url": str(data.url),
+                "image": str(data.image.url) if data.image is not None else None,
+                "fields": [
+                    (title, str(val))
+                    for title, val in qrz_process_info(data).items()
+                    if val is not None and str(val)
+                ],
+            }
+            self.cache.put(callsign, result)
+            return result
+
+        return await self.bot.qrm.singleflight.do(("qrz", callsign), search)
+
+    async def _save_session_key(self):
+        """Writes the session key back if the client had to log in again."""
+        session_key = self.qrz.session_key
+        if not session_key or session_key == self.session_key:
+            return
+        self.session_key = session_key
+        await asyncio.to_thread(write_session_key, session_key)
 
     @commands.slash_command(
         name="call",
@@ -104,8 +274,164 @@ class QRZCog(commands.Cog):
         async with ctx.typing():
             await ctx.send(embed=await self._qrz_lookup_core(ctx, callsign))
 
+    # endregion
+
+    # region QRZ Bulk Lookup
+
+    async def _qrz_bulk_core(
+        self,
+        ctx: Union[ApplicationContext, commands.Context],
+        calls: list[str],
+        update: Callable[[Embed], Awaitable],
+    ) -> Tuple[Optional[File], Embed]:
+        """Looks up many callsigns, `update`-ing with the results so far as they come in."""
+        if not self.qrz_ready:
+            self.setup_qrz()
+
+        calls = list(dict.fromkeys(c.upper() for c in calls if c))
+        truncated = len(calls) > max_bulk_calls
+        calls = calls[:max_bulk_calls]
+
+        embed = cmn.embed_factory(ctx)
+        embed.title = "QRZ Bulk Lookup"
+        embed.colour = cmn.colours.bad
+        if self.qrz is None and not self.local.sources:
+            embed.description = "QRZ lookups are not available."
+            return (None, embed)
+        if not calls:
+            embed.description = "No callsigns given! List them, or attach a file with one per line."
+            return (None, embed)
+
+        semaphore = asyncio.Semaphore(opt.qrz_concurrency)
+
+        async def lookup(call: str) -> Tuple[str, dict]:
+            async with semaphore:
+                try:
+                    result = await self._lookup(call)
+                except Exception as e:
+                    # only this callsign's row fails
+                    return call, {"error": f"Lookup failed: {e}"}
+            return call, result or {"error": "Only available on QRZ, which is not set up."}
+
+        results: dict[str, dict] = {}
+        last_update = time.monotonic()
+        for next_result in asyncio.as_completed([lookup(call) for call in calls]):
+            call, result = await next_result
+            results[call] = result
+            if time.monotonic() - last_update >= bulk_update_interval and len(results) < len(calls):
+                await update(bulk_embed(ctx, calls, results))
+                last_update = time.monotonic()
+
+        embed = bulk_embed(ctx, calls, results)
+        if truncated:
+            embed.description += f"\nOnly the first {max_bulk_calls} callsigns were looked up."
+
+        columns = ("Name", "Country", "Grid Square", "County", "License Class", "Expires")
+        rows = []
+        for call in calls:
+            result = results[call]
+            fields = dict(result.get("fields", ()))
+            rows.append(
+                (result.get("callsign", call),)
+                + tuple(fields.get(c, "") for c in columns)
+                + (result.get("url", ""), result.get("error", ""))
+            )
+        header = ("callsign",) + tuple(c.lower().replace(" ", "_") for c in columns) + ("url", "error")
+        file = cmn.csv_file("qrz.csv", header, rows)
+        return (file, embed)
+
+    @commands.slash_command(
+        name="callbulk",
+        integration_types={IntegrationType.guild_install, IntegrationType.user_install},
+    )
+    async def _qrz_bulk_slash(
+        self,
+        ctx: ApplicationContext,
+        callsigns: Option(str, "Callsigns to look up, separated by spaces or commas.", default=""),  # type: ignore
+        file: Option(discord.Attachment, "A file with callsigns to look up.", default=None),  # type: ignore
+    ):
+        """Looks up many callsigns on QRZ.com at once."""
+        await ctx.defer()
+        calls = call_split_regex.split(callsigns)
+        if file is not None:
+            calls += call_split_regex.split((await file.read()).decode(errors="replace"))
+
+        csv_file, embed = await self._qrz_bulk_core(ctx, calls, lambda e: ctx.edit(embed=e))
+        if csv_file:
+            await ctx.edit(embed=embed, file=csv_file)
+        else:
+            await ctx.edit(embed=embed)
+
+    @commands.command(name="callbulk", aliases=["qrzbulk"], category=cmn.Cats.LOOKUP)
+    async def _qrz_bulk_prefix(self, ctx: commands.Context, *, callsigns: str = ""):
+        """Looks up many callsigns on [QRZ.com](https://www.qrz.com/) at once. \
+        List the callsigns, or attach a file with them. Results are shown as they come in, \
+        and are also given as a CSV file."""
+        calls = call_split_regex.split(callsigns)
+        if ctx.message.attachments:
+            calls += call_split_regex.split((await ctx.message.attachments[0].read()).decode(errors="replace"))
 
-def qrz_process_info(data: CallsignData) -> Dict:
+        message = None
+
+        async def update(embed: Embed):
+            nonlocal message
+            if message is None:
+                message = await ctx.send(embed=embed)
+            else:
+                await message.edit(embed=embed)
+
+        async with ctx.typing():
+            file, embed = await self._qrz_bulk_core(ctx, calls, update)
+        if message is None:
+            if file:
+                await ctx.send(embed=embed, file=file)
+            else:
+                await ctx.send(embed=embed)
+        elif file:
+            await message.edit(embed=embed, file=file)
+        else:
+            await message.edit(embed=embed)
+
+    # endregion
+
+
+def write_session_key(session_key: str) -> None:
+    tmp = qrz_session_path.with_suffix(".tmp")
+    with tmp.open("w") as qrz_file:
+        qrz_file.write(session_key + "\n")
+    os.replace(tmp, qrz_session_path)
+
+
+def bulk_embed(ctx: Union[ApplicationContext, commands.Context], calls: list[str], results: dict[str, dict]) -> Embed:
+    """Lists the results of a bulk lookup so far, in the order the callsigns were given."""
+    embed = cmn.embed_factory(ctx)
+    embed.title = f"QRZ Data for {len(calls)} Callsign{'s' if len(calls) > 1 else ''}"
+    found = sum(1 for r in results.values() if "error" not in r)
+    if len(results) < len(calls):
+        embed.description = f"Looking up... {len(results)} of {len(calls)} done."
+        embed.colour = cmn.colours.neutral
+    else:
+        embed.description = f"Found **{found}** of **{len(calls)}** callsigns."
+        embed.colour = cmn.colours.good if found else cmn.colours.bad
+
+    lines = []
+    for call in calls:
+        result = results.get(call)
+        if result is None:
+            continue
+        if "error" in result:
+            lines.append(f"`{call}`: *{result['error']}*")
+        else:
+            fields = dict(result["fields"])
+            details = ", ".join(
+                fields[f] for f in ("Name", "Country", "Grid Square") if f in fields
+            )
+            lines.append(f"[`{result['callsign']}`]({result['url']}): {details}")
+    embed.description += "\n\n" + cmn.join_lines(lines, 3800 - len(embed.description))
+    return embed
+
+
+def qrz_process_info(data: "callsignlookuptools.CallsignData") -> Dict:
     if data.name is not None:
         if opt.qrz_only_nickname:
             nm = data.name.name if data.name.name is not None else ""
@@ -148,8 +474,8 @@ def qrz_process_info(data: CallsignData) -> Dict:
         "Born": data.born,
     } | qsl
 
-    # endregion
-
 
 def setup(bot):
-    bot.add_cog(QRZCog(bot))
+    qrzcog = QRZCog(bot)
+    bot.add_cog(qrzcog)
+    qrzcog._save_cache.start()
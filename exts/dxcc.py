@@ -7,29 +7,102 @@ Copyright (C) 2021-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
-import threading
-from typing import Union
+import asyncio
+import codecs
+import copy
+import os
+import re
+import time
+from collections import Counter
+from typing import AsyncIterator, Iterable, Optional, Tuple, Union
 from pathlib import Path
 
-from ctyparser import BigCty
-
-from discord import ApplicationContext, Embed, IntegrationType
+import discord
+from discord import ApplicationContext, Embed, File, IntegrationType, Option
 from discord.ext import commands, tasks
 
 import common as cmn
+from utils.lazy import lazy_import
+
+import data.options as opt
+
+
+ctyparser = lazy_import("ctyparser")
 
 
 cty_path = Path("./data/cty.json")
 
+# sanity check for downloaded data; there are 340 DXCC entities
+min_cty_entries = 340
+cty_keys = ("entity", "cq", "itu", "continent", "tz")
+
+# upper bound on the number of distinct callsigns resolved from one file
+max_bulk_calls = 20000
+
+adif_call_regex = re.compile(r"<call:(\d+)(?::[^>]*)?>", re.IGNORECASE)
+adif_tag_regex = re.compile(r"<(?:[a-z_]+:\d+|eoh|eor)", re.IGNORECASE)
+cabrillo_tag_regex = re.compile(r"^[A-Z-]+:")
+# needs a letter and a digit; excludes RSTs like 599 or 5NN
+call_regex = re.compile(r"(?=.*[A-Z])(?=.*\d)(?![1-5][1-9N][1-9N]$)[A-Z0-9/]{3,}")
+# grid locators in VHF exchanges look like callsigns too
+grid_regex = re.compile(r"[A-R]{2}\d{2}(?:[A-X]{2})?")
+
+
+class CtyIndex:
+    """Longest-prefix lookup structure compiled from a BigCty dataset.
+
+    Prefixes are stored in a character trie, so a callsign is resolved in a single
+    walk over its characters. Entries marked `exact_match` in cty.dat only match
+    when they are the whole query."""
+
+    def __init__(self, cty: "ctyparser.BigCty"):
+        self.cty = cty
+        self.version = cty.formatted_version
+        # each node is a dict of next character -> node; "" holds the entry ending here
+        self._root: dict = {}
+        for prefix, data in cty.items():
+            node = self._root
+            for char in prefix.upper():
+                node = node.setdefault(char, {})
+            node[""] = (prefix.upper(), data)
+
+    def __len__(self) -> int:
+        return len(self.cty)
+
+    def lookup(self, query: str) -> Optional[Tuple[str, dict]]:
+        """Finds the longest prefix matching `query`. Returns the prefix and its data."""
+        query = query.upper()
+        best = None
+        node = self._root
+        for i, char in enumerate(query, start=1):
+            node = node.get(char)
+            if node is None:
+                break
+            entry = node.get("")
+            if entry is not None and (i == len(query) or not entry[1].get("exact_match", False)):
+                best = entry
+        return best
+
 
 class DXCCCog(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        try:
-            self.cty = BigCty(cty_path)
-        except OSError:
-            self.cty = BigCty()
+        # Only ever replaced as a whole; readers should grab it once per lookup.
+        self.index: Optional[CtyIndex] = None
+        if not opt.lazy_imports:
+            self.get_index()
+        self.session = bot.qrm.http.session
+
+    def get_index(self) -> CtyIndex:
+        """Returns the current index, loading it from disk the first time."""
+        if self.index is None:
+            try:
+                cty = ctyparser.BigCty(cty_path)
+            except OSError:
+                cty = ctyparser.BigCty()
+            self.index = CtyIndex(cty)
+        return self.index
 
     # region dxcc
 
@@ -40,29 +113,26 @@ class DXCCCog(commands.Cog):
         private: bool = False,
     ) -> Embed:
         query = query.upper()
-        full_query = query
+        index = self.get_index()
         embed = cmn.embed_factory(ctx)
         embed.title = "DXCC Info for "
-        embed.description = f"*Last Updated: {self.cty.formatted_version}*"
+        embed.description = f"*Last Updated: {index.version}*"
         embed.colour = cmn.colours.bad
-        while query:
-            if query in self.cty.keys():
-                data = self.cty[query]
-                embed.add_field(name="Entity", value=data["entity"])
-                embed.add_field(name="CQ Zone", value=data["cq"])
-                embed.add_field(name="ITU Zone", value=data["itu"])
-                embed.add_field(name="Continent", value=data["continent"])
-                embed.add_field(
-                    name="Time Zone",
-                    value=f"+{data['tz']}" if data["tz"] > 0 else str(data["tz"]),
-                )
-                embed.title += query
-                embed.colour = cmn.colours.good
-                break
-            else:
-                query = query[:-1]
+        match = index.lookup(query)
+        if match is not None:
+            prefix, data = match
+            embed.add_field(name="Entity", value=data["entity"])
+            embed.add_field(name="CQ Zone", value=data["cq"])
+            embed.add_field(name="ITU Zone", value=data["itu"])
+            embed.add_field(name="Continent", value=data["continent"])
+            embed.add_field(
+                name="Time Zone",
+                value=f"+{data['tz']}" if data["tz"] > 0 else str(data["tz"]),
+            )
+            embed.title += prefix
+            embed.colour = cmn.colours.good
         else:
-            embed.title += full_query + " not found"
+            embed.title += query + " not found"
             embed.colour = cmn.colours.bad
         return embed
 
@@ -92,16 +162,224 @@ class DXCCCog(commands.Cog):
 
     # endregion
 
+    # region dxccbulk
+
+    async def _dxcc_bulk_core(
+        self,
+        ctx: Union[ApplicationContext, commands.Context],
+        lines: AsyncIterator[str],
+        name: str,
+    ) -> Tuple[Optional[File], Embed]:
+        index = self.get_index()
+        calls: dict[str, None] = {}
+        truncated = False
+        async for call in extract_calls(lines):
+            if call in calls:
+                continue
+            if len(calls) >= max_bulk_calls:
+                truncated = True
+                break
+            calls[call] = None
+
+        embed = cmn.embed_factory(ctx)
+        embed.title = f"DXCC Summary for {name}"
+        if not calls:
+            embed.description = "No callsigns found! Attach an ADIF or Cabrillo log, or a list of callsigns."
+            embed.colour = cmn.colours.bad
+            return (None, embed)
+
+        results = resolve_calls(index, calls)
+        entities: Counter = Counter()
+        cq_zones: Counter = Counter()
+        continents: Counter = Counter()
+        rows = []
+        for call, match in results.items():
+            if match is None:
+                rows.append((call, "", "", "", "", ""))
+                continue
+            prefix, data = match
+            entities[data["entity"]] += 1
+            cq_zones[data["cq"]] += 1
+            continents[data["continent"]] += 1
+            rows.append((call, prefix, data["entity"], data["cq"], data["itu"], data["continent"]))
+
+        found = sum(entities.values())
+        embed.description = (
+            f"Resolved **{found}** of **{len(results)}** unique callsigns"
+            f" to **{len(entities)}** entities.\n*Last Updated: {index.version}*"
+        )
+        if truncated:
+            embed.description += f"\nOnly the first {max_bulk_calls} callsigns were processed."
+        embed.colour = cmn.colours.good if found else cmn.colours.bad
+        if entities:
+            embed.add_field(name="Entities", value=format_counts(entities), inline=False)
+            embed.add_field(name="CQ Zones", value=format_counts(cq_zones))
+            embed.add_field(name="Continents", value=format_counts(continents))
+
+        file = cmn.csv_file("dxcc.csv", ("callsign", "prefix", "entity", "cq", "itu", "continent"), rows)
+        return (file, embed)
+
+    @commands.slash_command(
+        name="dxccbulk",
+        integration_types={IntegrationType.guild_install, IntegrationType.user_install},
+    )
+    async def _dxcc_bulk_slash(
+        self,
+        ctx: ApplicationContext,
+        log: Option(discord.Attachment, "An ADIF or Cabrillo log, or a list of callsigns."),  # type: ignore
+    ):
+        """Gets DXCC info for every callsign in a log file."""
+        await ctx.defer()
+        file, embed = await self._dxcc_bulk_core(ctx, self.stream_lines(log.url), log.filename)
+        if file:
+            await ctx.send_followup(file=file, embed=embed)
+        else:
+            await ctx.send_followup(embed=embed)
+
+    @commands.command(name="dxccbulk", aliases=["dxbulk"], category=cmn.Cats.LOOKUP)
+    async def _dxcc_bulk_prefix(self, ctx: commands.Context, *, calls: str = ""):
+        """Gets DXCC info for every callsign in an attached ADIF or Cabrillo log, \
+        or in a list of callsigns. Returns a summary and a CSV file."""
+        async with ctx.typing():
+            if ctx.message.attachments:
+                attachment = ctx.message.attachments[0]
+                lines = self.stream_lines(attachment.url)
+                name = attachment.filename
+            else:
+                lines = iter_async(calls.splitlines())
+                name = "message"
+            file, embed = await self._dxcc_bulk_core(ctx, lines, name)
+            if file:
+                await ctx.send(file=file, embed=embed)
+            else:
+                await ctx.send(embed=embed)
+
+    async def stream_lines(self, url: str) -> AsyncIterator[str]:
+        """Streams a text file line by line, without loading all of it in memory."""
+        async with self.session.get(url) as r:
+            if r.status != 200:
+                raise cmn.BotHTTPError(r)
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            buffer = ""
+            async for chunk in r.content.iter_chunked(65536):
+                buffer += decoder.decode(chunk)
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    yield line
+                # single-line ADIF: cut before a tag so no field is split
+                if len(buffer) > 65536 and (cut := buffer.rfind("<")) > 0:
+                    yield buffer[:cut]
+                    buffer = buffer[cut:]
+            buffer += decoder.decode(b"", final=True)
+            if buffer:
+                yield buffer
+
+    # endregion
+
     @tasks.loop(hours=24)
     async def _update_cty(self):
-        update = threading.Thread(target=run_update, args=(self.cty, cty_path))
-        update.start()
+        try:
+            current = await asyncio.to_thread(self.get_index)
+            index = await asyncio.to_thread(refresh_cty, current.cty, cty_path)
+        except Exception as ex:
+            print(f"[!!] Failed to update the cty data: {ex.__class__.__name__}: {ex}")
+            return
+        if index is not None:
+            self.index = index
+        elif cty_path.exists():
+            # the mtime marks the last successful check, see _before_update_cty
+            cty_path.touch()
+
+    @_update_cty.before_loop
+    async def _before_update_cty(self):
+        # with recent data on disk, leave loading it to the first lookup instead of
+        # startup, and only wait out what's left of the interval since it was saved
+        try:
+            saved = cty_path.stat().st_mtime
+        except FileNotFoundError:
+            return
+        await asyncio.sleep(max(0, saved + self._update_cty.hours * 3600 - time.time()))
+
+
+def refresh_cty(current: "ctyparser.BigCty", dump_loc: Path) -> Optional[CtyIndex]:
+    """Fetches new BigCTY data and compiles it, leaving `current` untouched.
+
+    Meant to run in a thread. The new data is validated, then written to a temporary
+    file that replaces `dump_loc` atomically. Returns None if there was no update."""
+    # the copy shares the old data, but update() replaces it instead of mutating it
+    fresh = copy.copy(current)
+    if not fresh.update():
+        return None
+    if not fresh.version or len(fresh) < min_cty_entries:
+        raise ValueError(f"Refusing cty data with {len(fresh)} entries (version '{fresh.version}')")
+    for prefix, data in fresh.items():
+        if any(key not in data for key in cty_keys):
+            raise ValueError(f"Malformed cty entry for '{prefix}'")
+
+    tmp_loc = dump_loc.with_name(dump_loc.name + ".tmp")
+    fresh.dump(tmp_loc)
+    if len(ctyparser.BigCty(tmp_loc)) != len(fresh):
+        raise ValueError("Written cty data does not match the downloaded data")
+    os.replace(tmp_loc, dump_loc)
+    return CtyIndex(fresh)
+
+
+async def extract_calls(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Extracts callsigns from lines of an ADIF log, a Cabrillo log, or a plain list.
+
+    For Cabrillo, the worked callsign is taken from after the sent exchange."""
+    adif = False
+    async for line in lines:
+        if not adif and adif_tag_regex.search(line):
+            adif = True
+        if adif:
+            for match in adif_call_regex.finditer(line):
+                start = match.end()
+                yield line[start:start + int(match.group(1))].strip().upper()
+            continue
+        line = line.strip().upper()
+        if line.startswith("QSO:"):
+            call = cabrillo_worked_call(line.split()[5:])
+            if call is not None:
+                yield call
+        elif not cabrillo_tag_regex.match(line):
+            for tok in re.split(r"[\s,;]+", line):
+                if call_regex.fullmatch(tok):
+                    yield tok
+
+
+def cabrillo_worked_call(fields: list[str]) -> Optional[str]:
+    """Finds the worked callsign in the fields of a Cabrillo QSO line after the time.
+
+    These are the sent callsign and exchange, then the received ones, which have the same
+    number of fields, and sometimes a transmitter ID at the end."""
+    if len(fields) < 2:
+        return None
+    call = fields[1 + (len(fields) - 2) // 2]
+    if call_regex.fullmatch(call) and not grid_regex.fullmatch(call):
+        return call
+    # not laid out as expected, take the first callsign that isn't the sender's
+    for tok in fields[1:]:
+        if tok != fields[0] and call_regex.fullmatch(tok) and not grid_regex.fullmatch(tok):
+            return tok
+    return None
+
+
+def resolve_calls(index: CtyIndex, calls: Iterable[str]) -> dict[str, Optional[Tuple[str, dict]]]:
+    """Resolves many callsigns against the same index. Returns the matching prefix and data of each."""
+    return {call: index.lookup(call) for call in calls}
+
+
+def format_counts(counter: Counter, limit: int = 15) -> str:
+    lines = [f"{key}: {count}" for key, count in counter.most_common(limit)]
+    if len(counter) > limit:
+        lines.append(f"*…and {len(counter) - limit} more*")
+    return "\n".join(lines)[:1024]
 
 
-def run_update(cty_obj, dump_loc):
-    update = cty_obj.update()
-    if update:
-        cty_obj.dump(dump_loc)
+async def iter_async(items: Iterable[str]) -> AsyncIterator[str]:
+    for item in items:
+        yield item
 
 
 def setup(bot: commands.Bot):
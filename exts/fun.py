@@ -8,6 +8,7 @@ SPDX-License-Identifier: LiLiQ-Rplus-1.1
 
 import json
 import random
+from array import array
 from typing import Union
 
 import discord.ext.commands as commands
@@ -25,7 +26,7 @@ class FunCog(commands.Cog):
         with open(cmn.paths.resources / "imgs.1.json") as file:
             self.imgs: dict = json.load(file)
         with open(cmn.paths.resources / "words.1.txt") as words_file:
-            self.words = words_file.read().lower().splitlines()
+            self.words, self.words_index = index_words(words_file.read())
 
     fun_cat = SlashCommandGroup(
         "fun",
@@ -113,10 +114,9 @@ class FunCog(commands.Cog):
     ) -> Embed:
         result = ""
         for char in msg.lower():
-            if char.isalpha():
-                result += random.choice(
-                    [word for word in self.words if word[0] == char]
-                )
+            if char.isalpha() and char in self.words_index:
+                start = random.choice(self.words_index[char])
+                result += self.words[start:self.words.index("\n", start)]
             else:
                 result += char
             result += " "
@@ -141,5 +141,21 @@ class FunCog(commands.Cog):
     # endregion
 
 
+def index_words(text: str) -> tuple[str, dict[str, array]]:
+    """Packs a newline-separated word list into one lowercase string,
+    and indexes the offset of each word by its first letter."""
+    words = text.lower().replace("\r\n", "\n")
+    if not words.endswith("\n"):
+        words += "\n"
+    index: dict[str, array] = {}
+    start = 0
+    while start < len(words):
+        end = words.index("\n", start)
+        if end > start:
+            index.setdefault(words[start], array("I")).append(start)
+        start = end + 1
+    return words, index
+
+
 def setup(bot: commands.Bot):
     bot.add_cog(FunCog(bot))
@@ -6,14 +6,28 @@ Copyright (C) 2019-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
-from typing import Union
-
-import gridtools
+import re
+from typing import Optional, Tuple, Union
 
+import discord
 import discord.ext.commands as commands
-from discord import ApplicationContext, Embed, IntegrationType, SlashCommandGroup
+from discord import ApplicationContext, Embed, File, IntegrationType, Option, SlashCommandGroup
 
 import common as cmn
+from utils.lazy import lazy_import
+
+
+gridtools = lazy_import("gridtools")
+maidenhead = lazy_import("utils.maidenhead")
+
+
+# upper bound on the number of distinct grids in one batch
+max_batch_grids = 20000
+
+adif_grid_regex = re.compile(r"<gridsquare:(\d+)(?::[^>]*)?>", re.IGNORECASE)
+grid_split_regex = re.compile(r"[\s,;]+")
+# a "lat, long" line, like from a GPS track export
+latlong_regex = re.compile(r"\s*(-?\d{1,2}(?:\.\d+)?)\s*[,;\s]\s*(-?\d{1,3}(?:\.\d+)?)\s*")
 
 
 class GridCog(commands.Cog):
@@ -127,17 +141,130 @@ class GridCog(commands.Cog):
         """Calculates the great circle distance and azimuthal bearing between two grid locators."""
         await ctx.send_response(embed=await self._dist_lookup_core(ctx, grid1, grid2))
 
+    async def _dist_batch_core(
+        self, ctx: Union[ApplicationContext, commands.Context], origin: str, grids: list[str]
+    ) -> Tuple[Optional[File], Embed]:
+        embed = cmn.embed_factory(ctx)
+        embed.colour = cmn.colours.bad
+        origin_grid = gridtools.Grid(origin)
+        embed.title = f"Great Circle Distances and Bearings from {origin_grid}"
+
+        grids = list(dict.fromkeys(g.upper() for g in grids if g))
+        invalid = [g for g in grids if not maidenhead.grid_regex.fullmatch(g)]
+        grids = [g for g in grids if maidenhead.grid_regex.fullmatch(g)]
+        truncated = len(grids) > max_batch_grids
+        grids = grids[:max_batch_grids]
+        if not grids:
+            embed.description = "No grid locators given! List them, or attach a log or a file with them."
+            return (None, embed)
+
+        lat, lon = maidenhead.decode(grids)
+        dist, bearing = maidenhead.distance_bearing(origin_grid.lat, origin_grid.long, lat, lon)
+        dist_mi = 0.6214 * dist
+
+        rows = []
+        lines = []
+        for i, grid in enumerate(grids):
+            grid = grid[:2] + grid[2:].lower()
+            rows.append(
+                (grid, f"{lat[i]:.5f}", f"{lon[i]:.5f}", f"{dist[i]:.1f}", f"{dist_mi[i]:.1f}", f"{bearing[i]:.1f}")
+            )
+            lines.append(f"**{grid}:** {dist[i]:.1f} km ({dist_mi[i]:.1f} mi), {bearing[i]:.1f}°")
+
+        farthest = int(dist.argmax())
+        embed.description = (
+            f"**{len(grids)}** grid{'s' if len(grids) > 1 else ''},"
+            f" farthest is **{grids[farthest][:2] + grids[farthest][2:].lower()}**"
+            f" at {dist[farthest]:.1f} km ({dist_mi[farthest]:.1f} mi)."
+        )
+        if truncated:
+            embed.description += f"\nOnly the first {max_batch_grids} grids were calculated."
+        if invalid:
+            # tokens can be anything, keep them from crowding out the results
+            shown = ", ".join(f"`{g[:12].replace('`', '')}`" for g in invalid[:10])
+            more = f" and {len(invalid) - 10} more" if len(invalid) > 10 else ""
+            embed.description += f"\nSkipped invalid grids: {shown}{more}."
+        embed.description += "\n\n" + cmn.join_lines(lines, 4000 - len(embed.description))
+        embed.colour = cmn.colours.good
+
+        header = ("grid", "lat", "long", "distance_km", "distance_mi", "bearing")
+        file = cmn.csv_file("griddist.csv", header, rows)
+        return (file, embed)
+
+    @grid_cat.command(
+        name="distances",
+    )
+    async def _dist_batch_slash(
+        self,
+        ctx: ApplicationContext,
+        origin: str,
+        grids: Option(str, "Grid locators, separated by spaces or commas.", default=""),  # type: ignore
+        file: Option(discord.Attachment, "An ADIF log, or a list of grids or lat/longs.", default=None),  # type: ignore
+    ):
+        """Calculates the great circle distance and azimuthal bearing from one grid locator to many."""
+        await ctx.defer()
+        targets = grid_split_regex.split(grids)
+        if file is not None:
+            targets += extract_grids((await file.read()).decode(errors="replace"))
+        csv_file, embed = await self._dist_batch_core(ctx, origin, targets)
+        if csv_file:
+            await ctx.respond(embed=embed, file=csv_file)
+        else:
+            await ctx.respond(embed=embed)
+
     @commands.command(
         name="griddistance",
         aliases=["griddist", "distance", "dist"],
         category=cmn.Cats.CALC,
     )
-    async def _dist_lookup_prefix(self, ctx: commands.Context, grid1: str, grid2: str):
-        """Calculates the great circle distance and azimuthal bearing between two grid locators."""
-        await ctx.send(embed=await self._dist_lookup_core(ctx, grid1, grid2))
+    async def _dist_lookup_prefix(self, ctx: commands.Context, grid1: str, *grids: str):
+        """Calculates the great circle distance and azimuthal bearing between two grid locators. \
+        Give more than one grid after the first, or attach an ADIF log or a file of grids or \
+        "lat, long" lines, \
+        to get the distance and bearing to each of them as a CSV file."""
+        if len(grids) == 1 and not ctx.message.attachments:
+            await ctx.send(embed=await self._dist_lookup_core(ctx, grid1, grids[0]))
+            return
+
+        targets = list(grids)
+        if ctx.message.attachments:
+            targets += extract_grids((await ctx.message.attachments[0].read()).decode(errors="replace"))
+        file, embed = await self._dist_batch_core(ctx, grid1, targets)
+        if file:
+            await ctx.send(embed=embed, file=file)
+        else:
+            await ctx.send(embed=embed)
 
     # endregion
 
 
+def extract_grids(text: str) -> list[str]:
+    """Extracts grid locators from an ADIF log, or from a list of grids or coordinates.
+
+    Lines with a latitude and longitude are converted to 6-character grids."""
+    found = []
+    for match in adif_grid_regex.finditer(text):
+        length = int(match.group(1))
+        found.append(text[match.end():match.end() + length].strip())
+    if found:
+        return found
+
+    coords: list[tuple[int, float, float]] = []
+    for line in text.splitlines():
+        latlong = latlong_regex.fullmatch(line)
+        if latlong and abs(float(latlong.group(1))) <= 90 and abs(float(latlong.group(2))) <= 180:
+            # filled in below, all converted at once
+            coords.append((len(found), float(latlong.group(1)), float(latlong.group(2))))
+            found.append("")
+            continue
+        # skip 2-character tokens, they are more likely to be words than fields
+        found += [tok for tok in grid_split_regex.split(line) if len(tok) >= 4 and maidenhead.grid_regex.fullmatch(tok)]
+    if coords:
+        _, lats, lons = zip(*coords)
+        for (i, _, _), grid in zip(coords, maidenhead.encode(lats, lons)):
+            found[i] = grid
+    return found
+
+
 def setup(bot: commands.Bot):
     bot.add_cog(GridCog(bot))
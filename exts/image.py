@@ -6,7 +6,6 @@ Copyright (C) 2019-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
-import aiohttp
 from typing import Union
 
 import discord.ext.commands as commands
@@ -23,7 +22,6 @@ class ImageCog(commands.Cog):
         self.bot = bot
         self.bandcharts = cmn.ImagesGroup(cmn.paths.resources / "bandcharts.1.json")
         self.maps = cmn.ImagesGroup(cmn.paths.resources / "maps.1.json")
-        self.session = aiohttp.ClientSession(connector=bot.qrm.connector)
 
     # region bandchart
 
@@ -7,17 +7,55 @@ Copyright (C) 2021-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
+import asyncio
 import re
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Union
 
 import aiohttp
 
-from typing import Union
-
 import discord
 import discord.ext.commands as commands
 from discord import ApplicationContext, Embed, IntegrationType, Option
 
 import common as cmn
+from utils.metar import Observation, iter_reports, parse_report, report_time, trend_table
+
+
+station_regex = re.compile(r"\w(\w|\d){2,3}")
+
+# When the next report is due after one was observed or issued, with some slack for
+# it to reach aviationweather.gov
+metar_interval = timedelta(hours=1, minutes=10)
+taf_interval = timedelta(hours=6, minutes=10)
+# Overdue reports are checked for this often
+min_ttl = timedelta(minutes=5)
+# Stations with no reports (usually not a real station) are not asked again for this long
+negative_ttl = timedelta(hours=1)
+# How long to wait on aviationweather.gov before showing an expired report instead
+revalidate_grace = 3.0
+max_cached_reports = 2000
+max_batch_stations = 20
+# Room for reports in an embed description, leaving some for the header
+report_page_size = 4000
+# Words that can come before the station in a report
+report_prefixes = {"METAR", "SPECI", "TAF", "AMD", "COR"}
+
+
+class CachedReport:
+    __slots__ = ("text", "expires")
+
+    def __init__(self, text: str, expires: datetime):
+        self.text = text
+        self.expires = expires
+
+
+class CachedObservations:
+    __slots__ = ("observations", "expires")
+
+    def __init__(self, observations: list[Observation], expires: datetime):
+        self.observations = observations
+        self.expires = expires
 
 
 class WeatherCog(commands.Cog):
@@ -25,7 +63,9 @@ class WeatherCog(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession(connector=bot.qrm.connector)
+        self.session = bot.qrm.http.session
+        self.reports: dict[tuple[str, str, int], CachedReport] = {}
+        self.observations: dict[tuple[str, int], CachedObservations] = {}
 
     weather_cat = discord.SlashCommandGroup(
         "weather",
@@ -205,34 +245,14 @@ area code, or GPS coords. See https://wttr.in/:help",
     async def _metar_core(
         self,
         ctx: Union[ApplicationContext, commands.Context],
-        airport: str,
+        airports: str,
         hours: int = 0,
-    ) -> Embed:
-        embed = cmn.embed_factory(ctx)
-        airport = airport.upper()
-
-        if not re.fullmatch(r"\w(\w|\d){2,3}", airport):
-            embed.title = "Invalid airport given!"
-            embed.colour = cmn.colours.bad
-            return embed
-
-        url = f"https://aviationweather.gov/api/data/metar?ids={airport}&format=raw&taf=false&hours={hours}"
-        async with self.session.get(url) as r:
-            if r.status != 200:
-                raise cmn.BotHTTPError(r)
-            metar = await r.text()
-
+    ) -> list[Embed]:
         if hours > 0:
-            embed.title = f"METAR for {airport} for the last {hours} hour{'s' if hours > 1 else ''}"
+            title = f"METAR for {{}} for the last {hours} hour{'s' if hours > 1 else ''}"
         else:
-            embed.title = f"Current METAR for {airport}"
-
-        embed.description = (
-            "Data from [aviationweather.gov](https://www.aviationweather.gov/)."
-        )
-        embed.colour = cmn.colours.good
-        embed.description += f"\n\n```\n{metar}\n```"
-        return embed
+            title = "Current METAR for {}"
+        return await self._reports_core(ctx, "metar", airports, title, hours)
 
     @commands.slash_command(
         name="metar",
@@ -243,16 +263,16 @@ area code, or GPS coords. See https://wttr.in/:help",
         ctx: ApplicationContext,
         airport: Option(
             str,
-            "Four character ICAO code identifying an airport.",
+            "ICAO code identifying an airport. Separate several with commas.",
             required=True,
-            min_length=4,
-            max_length=4,
+            min_length=3,
+            max_length=120,
         ),  # type: ignore
         hours: Option(int, "Hours of historical data to pull", default=0, max_value=500),  # type: ignore
     ):
-        """Gets current raw METAR (Meteorological Terminal Aviation Routine Weather Report) for an airport."""
+        """Gets current raw METAR (Meteorological Terminal Aviation Routine Weather Report) for airports."""
         await ctx.defer()
-        await ctx.send_response(embed=await self._metar_core(ctx, airport, hours))
+        await send_embeds(ctx, await self._metar_core(ctx, airport, hours))
 
     @commands.command(name="metar", category=cmn.Cats.WEATHER)
     async def _metar_prefix(self, ctx: commands.Context, airport: str, hours: int = 0):
@@ -260,69 +280,374 @@ area code, or GPS coords. See https://wttr.in/:help",
         Optionally, a number of hours can be given to show a number of hours of historical METAR data.
 
         Airports should be given as an \
-        [ICAO code](https://en.wikipedia.org/wiki/List_of_airports_by_IATA_and_ICAO_code)."""
+        [ICAO code](https://en.wikipedia.org/wiki/List_of_airports_by_IATA_and_ICAO_code). \
+        Several airports can be given at once, separated by commas: `KJFK,KLGA,KEWR`."""
         with ctx.typing():
-            await ctx.send(embed=await self._metar_core(ctx, airport, hours))
+            await send_embeds(ctx, await self._metar_core(ctx, airport, hours))
 
     # endregion
 
-    # region taf
+    # region metar summary
 
-    async def _taf_core(
-        self, ctx: Union[ApplicationContext, commands.Context], airport: str
-    ) -> Embed:
+    async def _metar_summary_core(
+        self,
+        ctx: Union[ApplicationContext, commands.Context],
+        airport: str,
+        hours: int = 0,
+    ) -> list[Embed]:
         embed = cmn.embed_factory(ctx)
         airport = airport.upper()
 
-        if not re.fullmatch(r"\w(\w|\d){2,3}", airport):
+        if not station_regex.fullmatch(airport):
             embed.title = "Invalid airport given!"
             embed.colour = cmn.colours.bad
-            return embed
+            return [embed]
 
-        url = f"https://aviationweather.gov/api/data/taf?ids={airport}&format=raw&metar=true"
-        async with self.session.get(url) as r:
-            if r.status != 200:
-                raise cmn.BotHTTPError(r)
-            taf = await r.text()
+        if hours > 0:
+            observations = await self._get_observations(airport, hours)
+        else:
+            text, _ = (await self._get_reports("metar", [airport]))[airport]
+            observations = list(iter_reports(text.splitlines()))
 
-        embed.title = f"Current TAF for {airport}"
-        embed.description = (
-            "Data from [aviationweather.gov](https://www.aviationweather.gov/)."
-        )
+        if not observations:
+            embed.title = f"No METAR found for {airport}!"
+            embed.colour = cmn.colours.bad
+            return [embed]
+
+        latest = observations[0]
+        embed.title = f"METAR Summary for {airport}"
+        embed.description = "Data from [aviationweather.gov](https://www.aviationweather.gov/)."
+        if latest.time is not None:
+            embed.description += f"\nObserved <t:{int(latest.time.timestamp())}:R>."
         embed.colour = cmn.colours.good
-        embed.description += f"\n\n```\n{taf}\n```"
-        return embed
+        embed.add_field(name="Flight Category", value=latest.category or "Unknown")
+        embed.add_field(name="Wind", value=latest.format_wind())
+        embed.add_field(name="Visibility", value=latest.format_visibility())
+        embed.add_field(name="Ceiling", value=latest.format_ceiling())
+        embed.add_field(name="Temperature/Dewpoint", value=latest.format_temperature())
+        embed.add_field(name="Altimeter", value=latest.format_altimeter())
+        embeds = [embed]
+
+        if hours > 0:
+            pages = paginate_reports([(None, trend_table(observations))], report_page_size)
+            for i, page in enumerate(pages, start=1):
+                trend = cmn.embed_factory(ctx)
+                trend.title = f"METAR Trend for {airport} for the last {hours} hour{'s' if hours > 1 else ''}"
+                if len(pages) > 1:
+                    trend.title += f" ({i}/{len(pages)})"
+                trend.description = page.lstrip("\n")
+                trend.colour = cmn.colours.good
+                embeds.append(trend)
+        return embeds
 
     @commands.slash_command(
-        name="taf",
+        name="metarsummary",
         integration_types={IntegrationType.guild_install, IntegrationType.user_install},
     )
-    async def _taf_slash(
+    async def _metar_summary_slash(
         self,
         ctx: ApplicationContext,
         airport: Option(
             str,
             "Four character ICAO code identifying an airport.",
             required=True,
-            min_length=4,
+            min_length=3,
             max_length=4,
         ),  # type: ignore
+        hours: Option(int, "Hours of history to show as a trend", default=0, max_value=500),  # type: ignore
+    ):
+        """Decodes the current METAR for an airport, optionally with a trend of past reports."""
+        await ctx.defer()
+        await send_embeds(ctx, await self._metar_summary_core(ctx, airport, hours))
+
+    @commands.command(name="metarsummary", aliases=["msum"], category=cmn.Cats.WEATHER)
+    async def _metar_summary_prefix(self, ctx: commands.Context, airport: str, hours: int = 0):
+        """Decodes the current METAR for an airport into wind, visibility, ceiling, temperature, \
+        altimeter and flight category. Optionally, a number of hours can be given to add a table \
+        of how conditions changed over that time.
+
+        Airports should be given as an \
+        [ICAO code](https://en.wikipedia.org/wiki/List_of_airports_by_IATA_and_ICAO_code)."""
+        with ctx.typing():
+            await send_embeds(ctx, await self._metar_summary_core(ctx, airport, hours))
+
+    # endregion
+
+    # region taf
+
+    async def _taf_core(
+        self, ctx: Union[ApplicationContext, commands.Context], airports: str
+    ) -> list[Embed]:
+        return await self._reports_core(ctx, "taf", airports, "Current TAF for {}")
+
+    @commands.slash_command(
+        name="taf",
+        integration_types={IntegrationType.guild_install, IntegrationType.user_install},
+    )
+    async def _taf_slash(
+        self,
+        ctx: ApplicationContext,
+        airport: Option(
+            str,
+            "ICAO code identifying an airport. Separate several with commas.",
+            required=True,
+            min_length=3,
+            max_length=120,
+        ),  # type: ignore
     ):
-        """Gets forecasted Terminal Aerodrome Forecast data for an airport. Includes the latest METAR data."""
+        """Gets forecasted Terminal Aerodrome Forecast data for airports. Includes the latest METAR data."""
         await ctx.defer()
-        await ctx.send_response(embed=await self._taf_core(ctx, airport))
+        await send_embeds(ctx, await self._taf_core(ctx, airport))
 
     @commands.command(name="taf", category=cmn.Cats.WEATHER)
     async def _taf_prefix(self, ctx: commands.Context, airport: str):
         """Gets forecasted raw TAF (Terminal Aerodrome Forecast) data for an airport. Includes the latest METAR data.
 
         Airports should be given as an \
-        [ICAO code](https://en.wikipedia.org/wiki/List_of_airports_by_IATA_and_ICAO_code)."""
+        [ICAO code](https://en.wikipedia.org/wiki/List_of_airports_by_IATA_and_ICAO_code). \
+        Several airports can be given at once, separated by commas: `KJFK,KLGA,KEWR`."""
         with ctx.typing():
-            await ctx.send(embed=await self._taf_core(ctx, airport))
+            await send_embeds(ctx, await self._taf_core(ctx, airport))
 
     # endregion
 
+    async def _reports_core(
+        self,
+        ctx: Union[ApplicationContext, commands.Context],
+        kind: str,
+        airports: str,
+        title: str,
+        hours: int = 0,
+    ) -> list[Embed]:
+        """Builds the pages of reports for one or more stations.
+
+        `title` is formatted with the list of stations."""
+        stations = list(dict.fromkeys(a for a in airports.upper().replace(" ", ",").split(",") if a))
+        invalid = [st for st in stations if not station_regex.fullmatch(st)]
+        if not stations or invalid or len(stations) > max_batch_stations:
+            embed = cmn.embed_factory(ctx)
+            if len(stations) > max_batch_stations:
+                embed.title = f"Too many airports given! The limit is {max_batch_stations}."
+            elif invalid:
+                embed.title = f"Invalid airport{'s' if len(invalid) > 1 else ''} given: {', '.join(invalid)}!"
+            else:
+                embed.title = "Invalid airport given!"
+            embed.colour = cmn.colours.bad
+            return [embed]
+
+        reports = await self._get_reports(kind, stations, hours)
+        found = [st for st in stations if reports[st][0].strip()]
+        missing = [st for st in stations if st not in found]
+        if not found:
+            embed = cmn.embed_factory(ctx)
+            embed.title = f"No {kind.upper()} found for {', '.join(missing)}!"
+            embed.colour = cmn.colours.bad
+            return [embed]
+
+        intro = "Data from [aviationweather.gov](https://www.aviationweather.gov/)."
+        if any(reports[st][1] for st in found):
+            intro += stale_notice
+        if missing:
+            intro += f"\nNo {kind.upper()} found for {', '.join(missing)}."
+
+        pages = paginate_reports(
+            [(st if len(stations) > 1 else None, reports[st][0]) for st in found],
+            report_page_size - len(intro),
+        )
+        embeds = []
+        for i, page in enumerate(pages, start=1):
+            embed = cmn.embed_factory(ctx)
+            embed.title = title.format(", ".join(found))
+            if len(pages) > 1:
+                embed.title += f" ({i}/{len(pages)})"
+            embed.description = intro + page
+            embed.colour = cmn.colours.good
+            embeds.append(embed)
+        return embeds
+
+    async def _get_reports(
+        self, kind: str, stations: list[str], hours: int = 0
+    ) -> dict[str, tuple[str, bool]]:
+        """Gets stations' reports, from the cache while they are still current.
+
+        Stations that need refreshing are fetched together in one request. Returns each
+        station's reports and whether they are an expired copy, which is shown if
+        aviationweather.gov is slow or failing and there is one to fall back on."""
+        now = datetime.now(timezone.utc)
+        results = {}
+        stale = {}
+        need = []
+        for station in stations:
+            entry = self.reports.get((kind, station, hours))
+            if entry is not None and entry.expires > now:
+                results[station] = (entry.text, False)
+            else:
+                need.append(station)
+                if entry is not None:
+                    stale[station] = entry.text
+
+        if need:
+            # identical concurrent requests share one refresh, which also keeps running
+            # in the background if we stop waiting for it
+            refresh = self.bot.qrm.singleflight.do(
+                (kind, tuple(need), hours),
+                lambda: self._refresh_reports(kind, need, hours),
+            )
+            try:
+                if len(stale) < len(need):
+                    fresh = await refresh
+                else:
+                    fresh = await asyncio.wait_for(refresh, revalidate_grace)
+                results.update((st, (fresh[st], False)) for st in need)
+            except (asyncio.TimeoutError, aiohttp.ClientError, cmn.BotHTTPError):
+                if len(stale) < len(need):
+                    raise
+                results.update((st, (text, True)) for st, text in stale.items())
+
+        return {station: results[station] for station in stations}
+
+    async def _refresh_reports(
+        self, kind: str, stations: list[str], hours: int
+    ) -> dict[str, str]:
+        ids = ",".join(stations)
+        if kind == "taf":
+            url = f"https://aviationweather.gov/api/data/taf?ids={ids}&format=raw&metar=true"
+        else:
+            url = f"https://aviationweather.gov/api/data/metar?ids={ids}&format=raw&taf=false&hours={hours}"
+        reports = split_by_station(await self._fetch_text(url), stations)
+
+        now = datetime.now(timezone.utc)
+        if len(self.reports) + len(stations) > max_cached_reports:
+            self.reports = {k: v for k, v in self.reports.items() if v.expires > now}
+        for station, text in reports.items():
+            self.reports[(kind, station, hours)] = CachedReport(text, report_expiry(text, now))
+        return reports
+
+    async def _get_observations(self, station: str, hours: int) -> list[Observation]:
+        """Gets a station's decoded METAR history, newest first."""
+        entry = self.observations.get((station, hours))
+        if entry is not None and entry.expires > datetime.now(timezone.utc):
+            return entry.observations
+        return await self.bot.qrm.singleflight.do(
+            ("metar-history", station, hours),
+            lambda: self._refresh_observations(station, hours),
+        )
+
+    async def _refresh_observations(self, station: str, hours: int) -> list[Observation]:
+        # up to 500 hours of reports: decode them as they arrive instead of keeping the text
+        url = f"https://aviationweather.gov/api/data/metar?ids={station}&format=raw&taf=false&hours={hours}"
+        now = datetime.now(timezone.utc)
+        observations = []
+        async with self.session.get(url) as r:
+            if r.status != 200:
+                raise cmn.BotHTTPError(r)
+            async for line in r.content:
+                if line[:1].isspace():
+                    continue
+                obs = parse_report(line.decode(errors="replace"), now)
+                if obs is not None:
+                    observations.append(obs)
+
+        if not observations:
+            expires = now + negative_ttl
+        else:
+            latest = max((o.time for o in observations if o.time), default=now)
+            expires = max(latest + metar_interval, now + min_ttl)
+        if len(self.observations) >= max_cached_reports:
+            self.observations = {k: v for k, v in self.observations.items() if v.expires > now}
+        self.observations[(station, hours)] = CachedObservations(observations, expires)
+        return observations
+
+    async def _fetch_text(self, url: str) -> str:
+        async with self.session.get(url) as r:
+            if r.status != 200:
+                raise cmn.BotHTTPError(r)
+            return await r.text()
+
+
+stale_notice = "\n*aviationweather.gov is not responding, these reports may be out of date.*"
+
+
+async def send_embeds(ctx: Union[ApplicationContext, commands.Context], embeds: list[Embed]):
+    """Sends embeds in as few messages as Discord's limits allow."""
+    # at most 10 embeds and 6000 characters across the embeds of a message
+    messages: list[list[Embed]] = [[]]
+    size = 0
+    for embed in embeds:
+        if messages[-1] and (len(messages[-1]) >= 10 or size + len(embed) > 6000):
+            messages.append([])
+            size = 0
+        messages[-1].append(embed)
+        size += len(embed)
+    for message in messages:
+        if isinstance(ctx, ApplicationContext):
+            await ctx.respond(embeds=message)
+        else:
+            await ctx.send(embeds=message)
+
+
+def split_by_station(text: str, stations: list[str]) -> dict[str, str]:
+    """Splits a multi-station response into each station's reports.
+
+    Lines that don't start a report (like a TAF's change groups) belong to the
+    report above them. Stations that got nothing map to an empty string. Reports come
+    back under ICAO identifiers, so 3-character FAA/IATA queries like JFK match
+    reports for KJFK."""
+    lines: dict[str, list[str]] = {station: [] for station in stations}
+    current = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if not line[0].isspace():
+            words = [w for w in line.split() if w not in report_prefixes]
+            if words and words[0] in lines:
+                current = words[0]
+            elif words and len(words[0]) == 4 and words[0][1:] in lines:
+                current = words[0][1:]
+        if current is not None:
+            lines[current].append(line)
+    return {station: "\n".join(station_lines) for station, station_lines in lines.items()}
+
+
+def paginate_reports(reports: list[tuple[Optional[str], str]], size: int) -> list[str]:
+    """Lays out (heading, text) pairs as code blocks, split into pages of at most `size`."""
+    pages = [""]
+    for heading, text in reports:
+        block_start = f"\n\n**{heading}**\n```\n" if heading else "\n\n```\n"
+        block = block_start
+        for line in text.splitlines():
+            line = line[: size - len(block_start) - 4]
+            if len(pages[-1]) + len(block) + len(line) + 4 > size:
+                if block != block_start:
+                    pages[-1] += block + "```"
+                pages.append("")
+                block = block_start
+            block += line + "\n"
+        pages[-1] += block + "```"
+    return [page for page in pages if page]
+
+
+def report_expiry(text: str, now: datetime) -> datetime:
+    """Works out when newer reports are due, from the times of the ones in `text`."""
+    if not text.strip():
+        return now + negative_ttl
+    latest_metar = latest_taf = None
+    for line in text.splitlines():
+        when = report_time(line, now)
+        if when is None:
+            continue
+        if line.lstrip().startswith("TAF"):
+            latest_taf = max(latest_taf or when, when)
+        else:
+            latest_metar = max(latest_metar or when, when)
+
+    due = [
+        when + interval
+        for when, interval in ((latest_metar, metar_interval), (latest_taf, taf_interval))
+        if when is not None
+    ]
+    return max(min(due, default=now), now + min_ttl)
+
 
 def setup(bot: commands.Bot):
     bot.add_cog(WeatherCog(bot))
@@ -6,18 +6,90 @@ Copyright (C) 2019-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
+import asyncio
+import time
 from datetime import datetime, timezone
 from io import BytesIO
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 
-import cairosvg
 import httpx
 
 import discord
 import discord.ext.commands as commands
+from discord.ext import tasks
 from discord import ApplicationContext, Embed, File, IntegrationType
 
 import common as cmn
+from utils.rasterizer import RasterizerBusy, RasterizerTimeout, SvgRasterizer
+
+
+class RenderedMap:
+    """An upstream SVG map, kept in memory as rendered PNG bytes.
+
+    Revalidated against the upstream's ETag/Last-Modified, so an unchanged map is
+    never downloaded or rendered twice. Concurrent requests share a single refresh."""
+
+    def __init__(self, url: str, max_age: float):
+        self.url = url
+        self.max_age = max_age
+        self.png: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.checked = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def fresh(self) -> bool:
+        return self.png is not None and time.monotonic() - self.checked < self.max_age
+
+    async def get(self, client: httpx.AsyncClient, rasterizer: SvgRasterizer) -> bytes:
+        """Returns the rendered map, refreshing it first if it is stale."""
+        if not self.fresh:
+            await self.revalidate(client, rasterizer)
+        return self.png  # type: ignore
+
+    async def revalidate(
+        self, client: httpx.AsyncClient, rasterizer: SvgRasterizer, force: bool = False
+    ) -> None:
+        """Refreshes the map, unless another caller did it while we were waiting."""
+        async with self._lock:
+            if not force and self.fresh:
+                return
+            try:
+                await self.refresh(client, rasterizer)
+            except (httpx.HTTPError, cmn.BotHTTPError, RasterizerBusy, RasterizerTimeout):
+                # an old map is better than no map
+                if self.png is None:
+                    raise
+
+    async def refresh(self, client: httpx.AsyncClient, rasterizer: SvgRasterizer) -> None:
+        """Fetches and renders the map if it changed upstream."""
+        headers = {}
+        if self.png is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+
+        resp = await client.get(self.url, headers=headers)
+        await resp.aclose()
+        if resp.status_code == 304 and self.png is not None:
+            self.checked = time.monotonic()
+            return
+        if resp.status_code != 200:
+            raise cmn.BotHTTPError(resp)
+
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        unchanged = self.png is not None and (
+            (etag is not None and etag == self.etag)
+            or (etag is None and last_modified is not None and last_modified == self.last_modified)
+        )
+        if not unchanged:
+            self.png = await rasterizer.render(await resp.aread())
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked = time.monotonic()
 
 
 class PropagationCog(commands.Cog):
@@ -37,20 +109,21 @@ class PropagationCog(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.httpx_client: httpx.AsyncClient = bot.qrm.httpx_client
+        self.httpx_client: httpx.AsyncClient = bot.qrm.http.httpx
+        self.rasterizer: SvgRasterizer = bot.qrm.rasterizer
+        # kc2g regenerates these every few minutes; the refresh task keeps them warm
+        self.muf_map = RenderedMap(self.muf_url, max_age=300)
+        self.fof2_map = RenderedMap(self.fof2_url, max_age=300)
+
+    def cog_unload(self):
+        self._refresh_maps.cancel()
 
     # region muf
 
     async def _mufmap_core(
         self, ctx: Union[ApplicationContext, commands.Context]
     ) -> Tuple[File, Embed]:
-        resp = await self.httpx_client.get(
-            self.muf_url
-        )  # TODO: put this in a context manager?
-        await resp.aclose()
-        if resp.status_code != 200:
-            raise cmn.BotHTTPError(resp)
-        out = BytesIO(cairosvg.svg2png(bytestring=await resp.aread()))  # type: ignore
+        out = BytesIO(await self.muf_map.get(self.httpx_client, self.rasterizer))
         file = discord.File(out, "muf_map.png")
         embed = cmn.embed_factory(ctx)
         embed.title = "Maximum Usable Frequency Map"
@@ -84,11 +157,7 @@ class PropagationCog(commands.Cog):
     async def _fof2map_core(
         self, ctx: Union[ApplicationContext, commands.Context]
     ) -> Tuple[File, Embed]:
-        resp = await self.httpx_client.get(self.fof2_url)
-        await resp.aclose()
-        if resp.status_code != 200:
-            raise cmn.BotHTTPError(resp)
-        out = BytesIO(cairosvg.svg2png(bytestring=await resp.aread()))  # type: ignore
+        out = BytesIO(await self.fof2_map.get(self.httpx_client, self.rasterizer))
         file = discord.File(out, "fof2_map.png")
         embed = cmn.embed_factory(ctx)
         embed.title = "Critical Frequency (foF2) Map"
@@ -215,6 +284,45 @@ class PropagationCog(commands.Cog):
 
     # endregion
 
+    # region rasterstats - prefix only
+
+    @commands.command(name="rasterstats", category=cmn.BoltCats.ADMIN)
+    @commands.check(cmn.check_if_owner)
+    async def _rasterstats(self, ctx: commands.Context):
+        """Shows the state of the SVG rendering worker pool."""
+        rasterizer = self.rasterizer
+        embed = cmn.embed_factory(ctx)
+        embed.title = "SVG Rendering Pool"
+        embed.add_field(name="Workers", value=str(rasterizer.workers))
+        embed.add_field(
+            name="Queue Depth",
+            value=f"{rasterizer.queue_depth}/{rasterizer.max_queue}",
+        )
+        embed.add_field(name="In Flight", value=str(rasterizer.in_flight))
+        embed.add_field(name="Completed", value=str(rasterizer.completed))
+        embed.add_field(name="Failed", value=str(rasterizer.failed))
+        embed.add_field(name="Pool Restarts", value=str(rasterizer.restarts))
+        embed.add_field(
+            name="Timed Out / Rejected",
+            value=f"{rasterizer.timed_out} / {rasterizer.rejected}",
+        )
+        embed.add_field(
+            name="Render Time", value=rasterizer.render_times.summary(), inline=False
+        )
+        await ctx.send(embed=embed)
+
+    # endregion
+
+    @tasks.loop(minutes=4)
+    async def _refresh_maps(self):
+        for rendered in (self.muf_map, self.fof2_map):
+            try:
+                await rendered.revalidate(self.httpx_client, self.rasterizer, force=True)
+            except Exception as ex:
+                print(f"[!!] Failed to refresh {rendered.url}: {ex.__class__.__name__}: {ex}")
+
 
 def setup(bot: commands.Bot):
-    bot.add_cog(PropagationCog(bot))
+    propcog = PropagationCog(bot)
+    bot.add_cog(propcog)
+    propcog._refresh_maps.start()
@@ -8,12 +8,15 @@ SPDX-License-Identifier: LiLiQ-Rplus-1.1
 
 import random
 import json
+import os
+import time
 from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable
 import asyncio
 
-import aiohttp
-
 import discord.ext.commands as commands
+from discord.ext import tasks
 from discord import IntegrationType, Option, AutocompleteContext, ApplicationContext
 from discord.utils import basic_autocomplete
 
@@ -21,6 +24,123 @@ import common as cmn
 from resources import study
 
 
+# element id -> sections -> questions
+IndexedPool = dict[str, list[list[dict]]]
+
+
+class PoolStore:
+    """HamStudy question pools, downloaded once and kept indexed in memory.
+
+    Snapshots are written to disk so restarts don't download every pool again.
+    Stale data keeps being served until `refresh_stale` replaces it."""
+
+    base_url = "https://hamstudy.org/pools/"
+    # only what is needed to ask a question
+    question_keys = ("id", "text", "answers", "answer", "image")
+
+    def __init__(self, path: Path, fetch_json: Callable[[str], Awaitable], max_age: float):
+        self.path = path
+        self.fetch_json = fetch_json
+        self.max_age = max_age
+        self.index: dict[str, dict] = {}
+        self.index_fetched = 0.0
+        self.pools: dict[str, IndexedPool] = {}
+        self.pools_fetched: dict[str, float] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    def _lock(self, key: str) -> asyncio.Lock:
+        return self._locks.setdefault(key, asyncio.Lock())
+
+    def _stale(self, fetched: float) -> bool:
+        return time.time() - fetched > self.max_age
+
+    async def get_index(self) -> dict[str, dict]:
+        """Returns the metadata of all available pools, keyed by pool id."""
+        if not self.index:
+            async with self._lock("index"):
+                if not self.index:
+                    await self._load_index()
+        return self.index
+
+    async def get_pool(self, pool_id: str) -> IndexedPool:
+        """Returns a pool's questions, indexed by element and section."""
+        if pool_id not in self.pools:
+            async with self._lock(pool_id):
+                if pool_id not in self.pools:
+                    await self._load_pool(pool_id)
+        return self.pools[pool_id]
+
+    async def refresh_stale(self) -> None:
+        """Re-downloads the index and every loaded pool that is older than `max_age`."""
+        if self.index and self._stale(self.index_fetched):
+            async with self._lock("index"):
+                await self._fetch_index()
+        for pool_id, fetched in list(self.pools_fetched.items()):
+            if self._stale(fetched):
+                async with self._lock(pool_id):
+                    await self._fetch_pool(pool_id)
+
+    async def _load_index(self) -> None:
+        snapshot = await asyncio.to_thread(self._read_snapshot, "index")
+        if snapshot is not None:
+            self.index = snapshot["data"]
+            self.index_fetched = snapshot["fetched"]
+        else:
+            await self._fetch_index()
+
+    async def _fetch_index(self) -> None:
+        pools_dict = await self.fetch_json(self.base_url)
+        index = dict()
+        for ls in pools_dict.values():
+            for pool in ls:
+                index[pool["id"]] = pool
+        self.index = index
+        self.index_fetched = time.time()
+        await asyncio.to_thread(self._write_snapshot, "index", index, self.index_fetched)
+
+    async def _load_pool(self, pool_id: str) -> None:
+        snapshot = await asyncio.to_thread(self._read_snapshot, pool_id)
+        if snapshot is not None:
+            # snapshots from before empty elements were left out may still have them
+            self.pools[pool_id] = {el: sections for el, sections in snapshot["data"].items() if sections}
+            self.pools_fetched[pool_id] = snapshot["fetched"]
+        else:
+            await self._fetch_pool(pool_id)
+
+    async def _fetch_pool(self, pool_id: str) -> None:
+        raw = (await self.fetch_json(self.base_url + pool_id))["pool"]
+        pool: IndexedPool = {
+            el["id"]: [
+                [
+                    {k: q[k] for k in self.question_keys if k in q}
+                    for q in section["questions"]
+                ]
+                for section in el["sections"]
+                if section["questions"]
+            ]
+            for el in raw
+            # an element with no questions at all has nothing to pick from
+            if any(section["questions"] for section in el["sections"])
+        }
+        self.pools[pool_id] = pool
+        self.pools_fetched[pool_id] = time.time()
+        await asyncio.to_thread(self._write_snapshot, pool_id, pool, self.pools_fetched[pool_id])
+
+    def _read_snapshot(self, name: str) -> dict | None:
+        try:
+            with (self.path / f"{name}.json").open("r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_snapshot(self, name: str, data, fetched: float) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = self.path / f"{name}.json.tmp"
+        with tmp.open("w") as file:
+            json.dump({"fetched": fetched, "data": data}, file)
+        os.replace(tmp, self.path / f"{name}.json")
+
+
 class StudyCog(commands.Cog):
     choices = {
         "A": cmn.emojis.a,
@@ -35,7 +155,13 @@ class StudyCog(commands.Cog):
         self.bot = bot
         self.lastq = dict()
         self.source = "Data courtesy of [HamStudy.org](https://hamstudy.org/)"
-        self.session = aiohttp.ClientSession(connector=bot.qrm.connector)
+        self.session = bot.qrm.http.session
+        self.pool_store = PoolStore(
+            cmn.paths.resources / "hamstudy", self.hamstudy_get_json, max_age=24 * 3600
+        )
+
+    def cog_unload(self):
+        self._refresh_pools.cancel()
 
     async def get_level_options(ctx: AutocompleteContext):
         country_type = ctx.options.get("country")
@@ -159,16 +285,19 @@ class StudyCog(commands.Cog):
 
         pool_meta = pools[pool]
 
-        async with self.session.get(f"https://hamstudy.org/pools/{pool}") as resp:
-            if resp.status != 200:
-                raise cmn.BotHTTPError(resp)
-            pool = json.loads(await resp.read())["pool"]
+        pool = await self.pool_store.get_pool(pool)
+        if not pool:
+            embed.title = "No Questions Available!"
+            embed.description = f"The question pool for Country `{country}` and Level `{level}` is empty."
+            embed.colour = cmn.colours.bad
+            await ctx.send_followup(embed=embed)
+            return
 
         # Select a question
         if element:
-            els = [el["id"] for el in pool]
-            if element in els:
-                pool_section = pool[els.index(element)]["sections"]
+            els = list(pool.keys())
+            if element in pool:
+                pool_section = pool[element]
             else:
                 embed.title = "Element Not Found!"
                 embed.description = f"Possible Elements for Country `{country}` and Level `{level}` are:"
@@ -177,8 +306,8 @@ class StudyCog(commands.Cog):
                 await ctx.send_followup(embed=embed)
                 return
         else:
-            pool_section = random.choice(pool)["sections"]
-        pool_questions = random.choice(pool_section)["questions"]
+            pool_section = pool[random.choice(list(pool.keys()))]
+        pool_questions = random.choice(pool_section)
         question = random.choice(pool_questions)
         answers = question["answers"]
         answers_str = ""
@@ -424,16 +553,19 @@ class StudyCog(commands.Cog):
 
             pool_meta = pools[pool]
 
-            async with self.session.get(f"https://hamstudy.org/pools/{pool}") as resp:
-                if resp.status != 200:
-                    raise cmn.BotHTTPError(resp)
-                pool = json.loads(await resp.read())["pool"]
+            pool = await self.pool_store.get_pool(pool)
+            if not pool:
+                embed.title = "No Questions Available!"
+                embed.description = f"The question pool for Country `{country}` and Level `{level}` is empty."
+                embed.colour = cmn.colours.bad
+                await ctx.send(embed=embed)
+                return
 
             # Select a question
             if element:
-                els = [el["id"] for el in pool]
-                if element in els:
-                    pool_section = pool[els.index(element)]["sections"]
+                els = list(pool.keys())
+                if element in pool:
+                    pool_section = pool[element]
                 else:
                     embed.title = "Element Not Found!"
                     embed.description = f"Possible Elements for Country `{country}` and Level `{level}` are:"
@@ -442,8 +574,8 @@ class StudyCog(commands.Cog):
                     await ctx.send(embed=embed)
                     return
             else:
-                pool_section = random.choice(pool)["sections"]
-            pool_questions = random.choice(pool_section)["questions"]
+                pool_section = pool[random.choice(list(pool.keys()))]
+            pool_questions = random.choice(pool_section)
             question = random.choice(pool_questions)
             answers = question["answers"]
             answers_str = ""
@@ -579,19 +711,28 @@ class StudyCog(commands.Cog):
     # endregion
 
     async def hamstudy_get_pools(self):
-        async with self.session.get("https://hamstudy.org/pools/") as resp:
-            if resp.status != 200:
-                raise cmn.BotHTTPError(resp)
-            else:
-                pools_dict = json.loads(await resp.read())
+        return await self.pool_store.get_index()
 
-        pools = dict()
-        for ls in pools_dict.values():
-            for pool in ls:
-                pools[pool["id"]] = pool
+    @tasks.loop(hours=1)
+    async def _refresh_pools(self):
+        try:
+            await self.pool_store.refresh_stale()
+        except Exception as ex:
+            print(f"[!!] Failed to refresh HamStudy pools: {ex.__class__.__name__}: {ex}")
+
+    async def hamstudy_get_json(self, url: str):
+        """Fetches and decodes a JSON document, sharing the request with identical concurrent ones."""
+
+        async def fetch():
+            async with self.session.get(url) as resp:
+                if resp.status != 200:
+                    raise cmn.BotHTTPError(resp)
+                return json.loads(await resp.read())
 
-        return pools
+        return await self.bot.qrm.singleflight.do(url, fetch)
 
 
 def setup(bot: commands.Bot):
-    bot.add_cog(StudyCog(bot))
+    studycog = StudyCog(bot)
+    bot.add_cog(studycog)
+    studycog._refresh_pools.start()
@@ -6,69 +6,152 @@ Copyright (C) 2021-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
-import aiohttp
+import asyncio
+import time
 from io import BytesIO
-from typing import Tuple, Union
+from typing import Awaitable, Callable, Optional, Tuple, Union
 from urllib.parse import urljoin
 
+import aiohttp
 import discord
 import discord.ext.commands as commands
 from discord import ApplicationContext, Embed, IntegrationType
 
 import common as cmn
 import data.options as opt
+from utils.admission import AdmissionControl, QueueFull, SlidingWindowLimiter
+from utils.metrics import LatencyWindow
+from utils.render_cache import RenderCache
+
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+
+
+class RenderRejected(Exception):
+    """Raised when rTeX's output is too large or not a PNG."""
 
 
 class TexCog(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession(connector=bot.qrm.connector)
+        self.session = bot.qrm.http.session
         with open(cmn.paths.resources / "template.1.tex") as latex_template:
             self.template = latex_template.read()
+        self.quality = 50
+        # renders are keyed on the template too, so editing it invalidates them
+        self.template_hash = RenderCache.key(self.template)
+        self.cache = RenderCache(cmn.paths.data / "texcache")
+
+        backends: list[str] = (
+            [opt.rtex_instance] if isinstance(opt.rtex_instance, str) else list(opt.rtex_instance)
+        )
+        self.admission = AdmissionControl(
+            backends, concurrency=opt.tex_concurrency, max_queue=opt.tex_max_queue
+        )
+        self.limiter = SlidingWindowLimiter(opt.tex_rate_limit, opt.tex_rate_period)
+        self.render_times = LatencyWindow()
+        self.rate_limited = 0
+        self.timed_out = 0
 
     # region tex
 
     async def _tex_core(
-        self, ctx: Union[ApplicationContext, commands.Context], expr: str
+        self,
+        ctx: Union[ApplicationContext, commands.Context],
+        expr: str,
+        on_queued: Optional[Callable[[int], Awaitable]] = None,
     ) -> Tuple[Union[discord.File, None], Embed]:
+        embed = cmn.embed_factory(ctx)
+        key = RenderCache.key(self.template_hash, expr, self.quality)
+        png = await self.cache.get(key)
+        if png is None:
+            # only renders that get a slot count against the limit, see below
+            retry_after = self.limiter.check(ctx.author.id)
+            if retry_after:
+                return (None, self.rate_limited_embed(embed, retry_after))
+
+            try:
+                async with self.admission.slot(on_queued) as backend:
+                    # checked again, in case other renders of theirs got in while this one waited
+                    retry_after = self.limiter.hit(ctx.author.id)
+                    if retry_after:
+                        return (None, self.rate_limited_embed(embed, retry_after))
+                    start = time.perf_counter()
+                    png = await asyncio.wait_for(
+                        self._render(backend, expr), opt.tex_timeout
+                    )
+                    self.render_times.add(time.perf_counter() - start)
+            except QueueFull:
+                embed.title = "LaTeX Renderer Busy!"
+                embed.description = "Too many expressions are waiting to be rendered. Try again later."
+                embed.colour = cmn.colours.bad
+                return (None, embed)
+            except RenderRejected as e:
+                embed.title = "LaTeX Rendering Failed!"
+                embed.description = str(e)
+                embed.colour = cmn.colours.bad
+                return (None, embed)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                embed.title = "LaTeX Rendering Timed Out!"
+                embed.description = f"Rendering took longer than {opt.tex_timeout} seconds."
+                embed.colour = cmn.colours.bad
+                return (None, embed)
+
+            if png is None:
+                embed.title = "LaTeX Rendering Failed!"
+                embed.description = (
+                    "Here are some common reasons:\n"
+                    "• Did you forget to use math mode? Surround math expressions with `$`,"
+                    " like `$x^3$`.\n"
+                    "• Are you using a command from a package? It might not be available.\n"
+                    "• Are you including the document headers? We already did that for you."
+                )
+                return (None, embed)
+            await self.cache.put(key, png)
+
+        embed.title = "LaTeX Expression"
+        embed.description = f"Rendered by [rTeX]({opt.rtex_attribution})."
+        embed.set_image(url="attachment://tex.png")
+        return (discord.File(BytesIO(png), "tex.png"), embed)
+
+    def rate_limited_embed(self, embed: Embed, retry_after: float) -> Embed:
+        self.rate_limited += 1
+        embed.title = "Slow Down!"
+        embed.description = (
+            f"You can render {opt.tex_rate_limit} expressions every "
+            f"{opt.tex_rate_period} seconds. Try again in {retry_after:.0f} seconds."
+        )
+        embed.colour = cmn.colours.bad
+        return embed
+
+    async def _render(self, backend: str, expr: str) -> Optional[bytes]:
+        """Renders an expression with an rTeX deployment. Returns None if LaTeX failed."""
         payload = {
             "format": "png",
             "code": self.template.replace("#CONTENT#", expr),
-            "quality": 50,
+            "quality": self.quality,
         }
 
         # ask rTeX to render our expression
         async with self.session.post(
-            urljoin(opt.rtex_instance, "api/v2"), json=payload
+            urljoin(backend, "api/v2"), json=payload
         ) as r:
             if r.status != 200:
                 raise cmn.BotHTTPError(r)
 
             render_result = await r.json()
             if render_result["status"] != "success":
-                embed = cmn.embed_factory(ctx)
-                embed.title = "LaTeX Rendering Failed!"
-                embed.description = (
-                    "Here are some common reasons:\n"
-                    "• Did you forget to use math mode? Surround math expressions with `$`,"
-                    " like `$x^3$`.\n"
-                    "• Are you using a command from a package? It might not be available.\n"
-                    "• Are you including the document headers? We already did that for you."
-                )
-                return (None, embed)
+                return None
 
         # if rendering went well, download the file given in the response
         async with self.session.get(
-            urljoin(opt.rtex_instance, "api/v2/" + render_result["filename"])
+            urljoin(backend, "api/v2/" + render_result["filename"])
         ) as r:
-            png_buffer = BytesIO(await r.read())
-
-        embed = cmn.embed_factory(ctx)
-        embed.title = "LaTeX Expression"
-        embed.description = f"Rendered by [rTeX]({opt.rtex_attribution})."
-        embed.set_image(url="attachment://tex.png")
-        return (discord.File(png_buffer, "tex.png"), embed)
+            if r.status != 200:
+                raise cmn.BotHTTPError(r)
+            return await read_png(r, opt.tex_max_size)
 
     @commands.slash_command(
         name="tex",
@@ -81,8 +164,20 @@ class TexCog(commands.Cog):
         """
         await ctx.defer()
 
-        file, embed = await self._tex_core(ctx, expr)
-        if file:
+        queued = False
+
+        async def on_queued(position: int):
+            nonlocal queued
+            queued = True
+            await ctx.edit(content=queue_notice(position))
+
+        file, embed = await self._tex_core(ctx, expr, on_queued)
+        # the queue notice took the deferred response, so replace it
+        if queued and file:
+            await ctx.edit(content=None, embed=embed, file=file)
+        elif queued:
+            await ctx.edit(content=None, embed=embed)
+        elif file:
             await ctx.send_followup(file=file, embed=embed)
         else:
             await ctx.send_followup(embed=embed)
@@ -93,15 +188,87 @@ class TexCog(commands.Cog):
 
         In paragraph mode by default. To render math, add `$` around math expressions.
         """
+        notice = None
+
+        async def on_queued(position: int):
+            nonlocal notice
+            if notice is None:
+                notice = await ctx.send(queue_notice(position), silent=True)
+            else:
+                await notice.edit(content=queue_notice(position))
+
         with ctx.typing():
-            file, embed = await self._tex_core(ctx, expr)
+            file, embed = await self._tex_core(ctx, expr, on_queued)
             if file:
                 await ctx.send(file=file, embed=embed)
             else:
                 await ctx.send(embed=embed)
+        if notice is not None:
+            await notice.delete()
 
         # endregion tex
 
+    # region texstats - prefix only
+
+    @commands.command(name="texstats", category=cmn.BoltCats.ADMIN)
+    @commands.check(cmn.check_if_owner)
+    async def _texstats(self, ctx: commands.Context):
+        """Shows the state of the LaTeX render queue and cache."""
+        admission = self.admission
+        embed = cmn.embed_factory(ctx)
+        embed.title = "LaTeX Rendering"
+        embed.add_field(
+            name="Queue Depth", value=f"{admission.queue_depth}/{admission.max_queue}"
+        )
+        embed.add_field(
+            name="In Flight",
+            value="\n".join(
+                f"`{backend}`: {active}/{admission.concurrency}"
+                for backend, active in admission.active.items()
+            ),
+        )
+        embed.add_field(
+            name="Rejected / Rate Limited / Timed Out",
+            value=f"{admission.rejected} / {self.rate_limited} / {self.timed_out}",
+        )
+        embed.add_field(
+            name="Cache",
+            value=(
+                f"{self.cache.hits} hits, {self.cache.misses} misses\n"
+                f"{self.cache.memory_size / 1024**2:.1f} MiB in memory, "
+                f"{self.cache.disk_size / 1024**2:.1f} MiB on disk"
+            ),
+        )
+        embed.add_field(
+            name="Render Time", value=self.render_times.summary(), inline=False
+        )
+        await ctx.send(embed=embed)
+
+    # endregion
+
+
+async def read_png(r: aiohttp.ClientResponse, max_size: int) -> bytes:
+    """Reads a PNG response body, giving up as soon as it is too large or not a PNG."""
+    if r.content_length is not None and r.content_length > max_size:
+        raise RenderRejected("The rendered image is too large.")
+    body = bytearray()
+    checked = False
+    async for chunk in r.content.iter_chunked(64 * 1024):
+        body += chunk
+        if len(body) > max_size:
+            raise RenderRejected("The rendered image is too large.")
+        if not checked and len(body) >= len(png_signature):
+            if not body.startswith(png_signature):
+                raise RenderRejected("The renderer did not return an image.")
+            checked = True
+    if not checked:
+        raise RenderRejected("The renderer did not return an image.")
+    return bytes(body)
+
+
+def queue_notice(position: int) -> str:
+    return f"{cmn.emojis.stopwatch} Your expression is #{position} in the render queue."
+
 
 def setup(bot: commands.Bot):
     bot.add_cog(TexCog(bot))
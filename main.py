@@ -9,14 +9,15 @@ SPDX-License-Identifier: LiLiQ-Rplus-1.1
 
 
 import asyncio
+import importlib.abc
 import random
 import sys
 import traceback
 from datetime import datetime, time
+from time import perf_counter
 from types import SimpleNamespace
 from pathlib import Path
 
-import httpx
 import pytz
 
 import discord
@@ -25,12 +26,19 @@ from discord.ext import commands, tasks
 import info
 import common as cmn
 import utils.connector as conn
+import utils.http_clients as http_clients
+from utils.keywords import KeywordMatcher
+from utils.rasterizer import SvgRasterizer
 from utils.resources_manager import ResourcesManager
+from utils.singleflight import SingleFlight
 
 import data.keys as keys
 import data.options as opt
 
 
+startup_start = perf_counter()
+
+
 # --- Settings ---
 
 exit_code = 1  # The default exit code. ?shutdown and ?restart will change it accordingly (fail-safe)
@@ -53,6 +61,8 @@ except RuntimeError:
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 connector = loop.run_until_complete(conn.new_connector())
+# Outbound HTTP for extensions; the connector above is for Discord only
+http = loop.run_until_complete(http_clients.new_clients())
 
 # Defining the intents
 intents = discord.Intents.default()
@@ -64,7 +74,26 @@ intents.message_content = True
 
 member_cache = discord.MemberCacheFlags.from_intents(intents)
 
-bot = commands.Bot(
+
+class QrmBot(commands.Bot):
+    async def close(self):
+        """Unloads the extensions, so they can save their state, then closes everything.
+
+        Every way of stopping goes through here, including signals caught by run()."""
+        if self.is_closed():
+            return
+        # commands.Bot.close() is meant to do this, but misses extensions loaded through pycord
+        for ext in tuple(self.extensions):
+            try:
+                self.unload_extension(ext)
+            except Exception as ex:
+                print(f"[!!] Failed to unload {ext}: {ex.__class__.__name__}: {ex}")
+        await self.qrm.http.close()
+        self.qrm.rasterizer.shutdown()
+        await super().close()
+
+
+bot = QrmBot(
     command_prefix=opt.prefix,
     case_insensitive=True,
     description=info.description,
@@ -80,9 +109,21 @@ bot.qrm = SimpleNamespace()
 
 # Let's store stuff here.
 bot.qrm.connector = connector
+# Startup wall times, in seconds. extensions maps names to (import, setup)
+bot.qrm.startup = SimpleNamespace(extensions={}, resources=0.0, total=0.0)
 bot.qrm.debug_mode = debug_mode
-# TODO: Add code to close the client
-bot.qrm.httpx_client = httpx.AsyncClient()
+bot.qrm.http = http
+# SVG to PNG rendering happens in worker processes, off the event loop
+bot.qrm.rasterizer = SvgRasterizer()
+# Identical outbound requests made at the same time share one upstream call
+bot.qrm.singleflight = SingleFlight()
+# Keyword auto-reacts: matched in one pass per message, emojis resolved once
+bot.qrm.react_matcher = KeywordMatcher(opt.msg_reacts)
+bot.qrm.react_emojis = {}
+# Filtered help listings, per kind of context; cleared when extensions change
+bot.qrm.help_cache = {}
+# Parsed CHANGELOG.md as (mtime, versions), kept across reloads of base
+bot.qrm.changelog = None
 
 
 # --- Commands ---
@@ -122,6 +163,37 @@ async def _refresh_slash_command(ctx: commands.Context, guilds: str | None = Non
         await bot.sync_commands()
 
 
+@bot.command(name="httpstats", category=cmn.BoltCats.ADMIN)
+@commands.check(cmn.check_if_owner)
+async def _http_stats(ctx: commands.Context):
+    """Shows how busy the shared HTTP connection pools are."""
+    stats = bot.qrm.http.stats()
+    embed = cmn.embed_factory(ctx)
+    embed.title = "HTTP Connection Pools"
+    embed.add_field(
+        name="aiohttp",
+        value=(
+            f"In use: {stats['aiohttp_in_use']}/{bot.qrm.http.limit}\n"
+            f"Waiting for a connection: {stats['aiohttp_waiting']}"
+        ),
+    )
+    embed.add_field(
+        name="httpx",
+        value=(
+            f"Open: {stats['httpx_open']} ({stats['httpx_idle']} idle)\n"
+            f"HTTP/2: {'yes' if stats['httpx_http2'] else 'no'}"
+        ),
+    )
+    if stats["aiohttp_hosts"]:
+        busiest = sorted(stats["aiohttp_hosts"].items(), key=lambda h: -h[1])[:10]
+        embed.add_field(
+            name=f"Busiest Hosts (limit {bot.qrm.http.limit_per_host} per host)",
+            value="\n".join(f"`{host}`: {count}" for host, count in busiest),
+            inline=False,
+        )
+    await ctx.send(embed=embed)
+
+
 @bot.group(
     name="extctl", aliases=["ex"], case_insensitive=True, category=cmn.BoltCats.ADMIN
 )
@@ -155,6 +227,15 @@ async def _extctl_list(ctx: commands.Context):
     await ctx.send(embed=embed)
 
 
+@_extctl.command(name="timings", aliases=["prof"])
+async def _extctl_timings(ctx: commands.Context):
+    """Shows how long each extension took to import and set up at startup."""
+    embed = cmn.embed_factory(ctx)
+    embed.title = "Startup Timings"
+    embed.description = f"```\n{format_startup_times()}\n```"
+    await ctx.send(embed=embed)
+
+
 @_extctl.command(name="load", aliases=["ld"])
 async def _extctl_load(ctx: commands.Context, extension: str):
     """Loads an extension."""
@@ -165,6 +246,7 @@ async def _extctl_load(ctx: commands.Context, extension: str):
             bot.load_extension(plugin_dir + "." + extension)
         except discord.errors.ExtensionNotFound:
             raise e
+    bot.qrm.help_cache.clear()
     await cmn.add_react(ctx.message, cmn.emojis.check_mark)
 
 
@@ -182,6 +264,7 @@ async def _extctl_reload(ctx: commands.Context, extension: str):
             bot.reload_extension(plugin_dir + "." + extension)
         except discord.errors.ExtensionNotLoaded:
             raise e
+    bot.qrm.help_cache.clear()
     await cmn.add_react(ctx.message, cmn.emojis.check_mark)
 
 
@@ -195,6 +278,7 @@ async def _extctl_unload(ctx: commands.Context, extension: str):
             bot.unload_extension(plugin_dir + "." + extension)
         except discord.errors.ExtensionNotLoaded:
             raise e
+    bot.qrm.help_cache.clear()
     await cmn.add_react(ctx.message, cmn.emojis.check_mark)
 
 
@@ -215,16 +299,24 @@ async def on_ready():
 
 @bot.event
 async def on_message(message):
-    msg = message.content.lower()
-    for emoji, keywords in opt.msg_reacts.items():
-        if any([keyword in msg for keyword in keywords]):
-            await message.add_reaction(
-                discord.utils.find(lambda x: x.id == emoji, bot.emojis)
-            )
+    if bot.qrm.react_matcher:
+        for emoji_id in bot.qrm.react_matcher.match(message.content.lower()):
+            emoji = bot.qrm.react_emojis.get(emoji_id)
+            if emoji is None:
+                emoji = bot.get_emoji(emoji_id)
+                if emoji is None:
+                    continue
+                bot.qrm.react_emojis[emoji_id] = emoji
+            await message.add_reaction(emoji)
 
     await bot.process_commands(message)
 
 
+@bot.event
+async def on_guild_emojis_update(guild, before, after):
+    bot.qrm.react_emojis.clear()
+
+
 @bot.event
 async def on_command_error(ctx: commands.Context, err: commands.CommandError):
     if isinstance(err, commands.UserInputError):
@@ -345,6 +437,79 @@ async def _ensure_activity_fixed():
     await bot.change_presence(activity=discord.Game(name=status))
 
 
+# --- Startup helpers ---
+
+
+class TimedLoader(importlib.abc.Loader):
+    """Wraps a module's loader to time running the module."""
+
+    def __init__(self, loader: importlib.abc.Loader):
+        self.loader = loader
+        self.elapsed = 0.0
+
+    def __getattr__(self, name: str):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.elapsed = perf_counter() - start
+
+
+class TimedFinder(importlib.abc.MetaPathFinder):
+    """Finds one module like the other finders would, but with a `TimedLoader`."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.loader: TimedLoader | None = None
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != self.name:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None and spec.loader is not None:
+                self.loader = spec.loader = TimedLoader(spec.loader)
+                return spec
+        return None
+
+
+def load_extension_timed(name: str):
+    """Loads an extension, recording how long importing it and running its setup took."""
+    # load_extension() runs the module then its setup(); the finder times the first part
+    finder = TimedFinder(name)
+    sys.meta_path.insert(0, finder)
+    try:
+        start = perf_counter()
+        bot.load_extension(name)
+        total = perf_counter() - start
+    finally:
+        sys.meta_path.remove(finder)
+    imported = finder.loader.elapsed if finder.loader is not None else 0.0
+    bot.qrm.startup.extensions[name] = (imported, total - imported)
+
+
+def format_startup_times() -> str:
+    startup = bot.qrm.startup
+    lines = [f"{'':<24} {'import':>9} {'setup':>9}"]
+    for name, (imp, setup) in sorted(
+        startup.extensions.items(), key=lambda item: -sum(item[1])
+    ):
+        lines.append(f"{name:<24} {imp * 1000:>6.0f} ms {setup * 1000:>6.0f} ms")
+    lines.append(f"Resources sync: {startup.resources * 1000:.0f} ms")
+    lines.append(f"Total startup: {startup.total * 1000:.0f} ms")
+    if opt.lazy_imports:
+        lines.append("(lazy imports enabled)")
+    return "\n".join(lines)
+
+
 # --- Run ---
 
 resource_versions = {
@@ -358,14 +523,19 @@ resource_versions = {
     "latex_template": "v1",
 }
 
+rm_start = perf_counter()
 bot.qrm.rm = ResourcesManager(cmn.paths.resources, opt.resources_url, resource_versions)
+bot.qrm.startup.resources = perf_counter() - rm_start
 
 for ext in opt.exts:
-    bot.load_extension(ext_dir + "." + ext)
+    load_extension_timed(ext_dir + "." + ext)
 
 # load all py files in plugin_dir
 for plugin in (f.stem for f in Path(plugin_dir.replace(".", "/")).glob("*.py")):
-    bot.load_extension(plugin_dir + "." + plugin)
+    load_extension_timed(plugin_dir + "." + plugin)
+
+bot.qrm.startup.total = perf_counter() - startup_start
+print(format_startup_times())
 
 
 try:
@@ -49,6 +49,10 @@ exts = [
     "time",
 ]
 
+# Defer importing heavy dependencies (ctyparser, gridtools, callsignlookuptools) until
+# a command first needs them. Speeds up startup, at the cost of a slower first use.
+lazy_imports = False
+
 # URL to the resources
 resources_url = "https://qrmresources.miaow.io/resources/"
 
@@ -56,6 +60,11 @@ resources_url = "https://qrmresources.miaow.io/resources/"
 # if False: use QRZ's default name format
 qrz_only_nickname = True
 
+# How many QRZ lookups ?callbulk runs at once, and how many lookups per second
+# (across all commands) the bot may make to QRZ.
+qrz_concurrency = 4
+qrz_rate_limit = 5
+
 # enable a command that provides a link to add the bot to a server
 enable_invite_cmd = True
 
@@ -95,3 +104,16 @@ pika = 1271888780340756651
 # Base URL to a deployment of rTeX, which performs LaTeX rendering.
 rtex_instance = "http://rtex:5000"
 rtex_attribution = "https://rtex.probablyaweb.site/"
+
+# Limits on ?tex renders, to keep bursts from overloading rTeX.
+# rtex_instance can also be a list of URLs to spread renders across several deployments.
+# How many renders may run at once on each rTeX deployment, and how many may wait for one.
+tex_concurrency = 2
+tex_max_queue = 10
+# How many renders (not counting cached ones) each user may request per tex_rate_period seconds.
+tex_rate_limit = 5
+tex_rate_period = 60
+# Seconds to wait for a render before giving up.
+tex_timeout = 30
+# Largest rendered image to accept from rTeX, in bytes.
+tex_max_size = 8 * 1024**2
@@ -0,0 +1,146 @@
+"""
+Admission control for rate-sensitive backends.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional
+
+
+class QueueFull(Exception):
+    """Raised when every backend is busy and the wait queue is full."""
+
+
+class SlidingWindowLimiter:
+    """Allows each key at most `limit` hits in any `period` seconds."""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self._hits: dict[Hashable, deque[float]] = {}
+
+    def check(self, key: Hashable) -> float:
+        """Returns 0 if `key` could hit now, or how long until it could, without recording a hit."""
+        now = time.monotonic()
+        hits = self._hits.get(key)
+        if not hits:
+            return 0.0
+        while hits and hits[0] <= now - self.period:
+            hits.popleft()
+        if len(hits) >= self.limit:
+            return hits[0] + self.period - now
+        return 0.0
+
+    def hit(self, key: Hashable) -> float:
+        """Records a hit for `key` if allowed. Returns 0, or how long until it would be."""
+        retry_after = self.check(key)
+        if retry_after:
+            return retry_after
+        now = time.monotonic()
+        hits = self._hits.get(key)
+        if hits is None:
+            if len(self._hits) > 1000:
+                self._sweep(now)
+            hits = self._hits[key] = deque()
+        hits.append(now)
+        return 0.0
+
+    def _sweep(self, now: float) -> None:
+        self._hits = {k: h for k, h in self._hits.items() if h and h[-1] > now - self.period}
+
+
+class AdmissionControl:
+    """Hands out a bounded number of concurrent slots on each of a set of backends.
+
+    Callers that can't get a slot right away wait in a single FIFO queue of at most
+    `max_queue` entries; past that, `QueueFull` is raised instead of piling up work.
+    Waiting callers are told their position again when it changes, at most every
+    `update_interval` seconds."""
+
+    def __init__(
+        self,
+        backends: list[str],
+        concurrency: int = 2,
+        max_queue: int = 10,
+        update_interval: float = 5.0,
+    ):
+        self.concurrency = concurrency
+        self.update_interval = update_interval
+        self.max_queue = max_queue
+        self.active = {backend: 0 for backend in backends}
+        self._waiters: deque[asyncio.Future] = deque()
+        self.rejected = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(self.active.values())
+
+    def _free_backend(self) -> Optional[str]:
+        backend = min(self.active, key=lambda b: self.active[b])
+        return backend if self.active[backend] < self.concurrency else None
+
+    async def _acquire(self, on_queued: Optional[Callable[[int], Awaitable]]) -> str:
+        backend = self._free_backend()
+        if backend is not None and not self._waiters:
+            self.active[backend] += 1
+            return backend
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull("Too many requests are queued, try again later.")
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            if on_queued is None:
+                return await fut
+            position = len(self._waiters)
+            await on_queued(position)
+            while True:
+                try:
+                    return await asyncio.wait_for(asyncio.shield(fut), self.update_interval)
+                except asyncio.TimeoutError:
+                    if fut.done():
+                        continue
+                new_position = self._waiters.index(fut) + 1
+                if new_position != position:
+                    position = new_position
+                    await on_queued(position)
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # we were handed a slot just as we gave up
+                self._release(fut.result())
+            elif fut in self._waiters:
+                self._waiters.remove(fut)
+            raise
+
+    def _release(self, backend: str) -> None:
+        # hand the slot straight to the next waiter, so nobody can cut the queue
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(backend)
+                return
+        self.active[backend] -= 1
+
+    @asynccontextmanager
+    async def slot(
+        self, on_queued: Optional[Callable[[int], Awaitable]] = None
+    ) -> AsyncIterator[str]:
+        """Waits for a slot and yields the backend it is on.
+
+        If the caller has to wait, `on_queued` is awaited with their queue position."""
+        backend = await self._acquire(on_queued)
+        try:
+            yield backend
+        finally:
+            self._release(backend)
@@ -0,0 +1,470 @@
+"""
+Local callsign database for qrm, built from the FCC and ISED license dumps.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+
+Usage:
+    python -m utils.callsign_db [--db PATH] uls l_amat.zip
+    python -m utils.callsign_db [--db PATH] uls-daily l_am_mon.zip l_am_tue.zip ...
+    python -m utils.callsign_db [--db PATH] ised amateur_delim.zip
+"""
+
+import argparse
+import io
+import re
+import sqlite3
+import sys
+import zipfile
+from contextlib import closing
+from datetime import datetime, timezone
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+
+default_path = Path("data/callsigns.sqlite3")
+batch_size = 50000
+
+us_call_regex = re.compile(r"(?:[KNW][A-Z]?|A[A-L])\d[A-Z]{1,3}")
+ca_call_regex = re.compile(r"(?:V[A-GOXY]|C[F-KYZ]|X[J-O])\d[A-Z]{1,3}")
+
+# table: ((column, ULS field index), ...), from the ULS public access file definitions
+uls_tables = {
+    "HD": (
+        "uls_hd",
+        (("usi", 1), ("callsign", 4), ("status", 5), ("grant_date", 7),
+         ("expired_date", 8), ("cancelled_date", 9)),
+    ),
+    "EN": (
+        "uls_en",
+        (("usi", 1), ("callsign", 4), ("entity_type", 5), ("name", 7), ("first_name", 8),
+         ("last_name", 10), ("suffix", 11), ("street", 15), ("city", 16), ("state", 17),
+         ("zip", 18), ("frn", 22)),
+    ),
+    "AM": (
+        "uls_am",
+        (("usi", 1), ("callsign", 4), ("operator_class", 5), ("trustee_callsign", 8),
+         ("previous_callsign", 15)),
+    ),
+}
+uls_indexes = {"uls_hd": ("usi", "callsign"), "uls_en": ("usi",), "uls_am": ("usi",)}
+uls_date_columns = {"grant_date", "expired_date", "cancelled_date"}
+
+uls_statuses = {"A": "Active", "C": "Cancelled", "E": "Expired", "T": "Terminated"}
+uls_classes = {
+    "E": "Amateur Extra",
+    "A": "Advanced",
+    "G": "General",
+    "P": "Technician Plus",
+    "T": "Technician",
+    "N": "Novice",
+}
+
+ised_columns = ("callsign", "first_name", "surname", "address", "city", "province",
+                "postal_code", "qualifications", "club_name")
+# qual_a to qual_e in the ISED file
+ised_qualifications = ("Basic", "5 WPM", "12 WPM", "Advanced", "Basic with Honours")
+
+
+class CallsignDB:
+    """Read-only lookups in the local callsign database."""
+
+    def __init__(self, path: Path = default_path):
+        self.path = path
+        self.sources: set[str] = set()
+        self.reload()
+
+    def reload(self) -> None:
+        """Checks which license dumps have been imported."""
+        self.sources = set()
+        if not self.path.is_file():
+            return
+        with closing(self._connect()) as conn:
+            try:
+                rows = conn.execute("SELECT key FROM meta WHERE key LIKE '%_imported'").fetchall()
+            except sqlite3.OperationalError:
+                return
+        self.sources = {key.removesuffix("_imported") for (key,) in rows}
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+
+    def covers(self, callsign: str) -> bool:
+        """Whether this callsign would be in the database if it exists."""
+        if "uls" in self.sources and us_call_regex.fullmatch(callsign):
+            return True
+        return "ised" in self.sources and bool(ca_call_regex.fullmatch(callsign))
+
+    def lookup(self, callsign: str) -> Optional[dict]:
+        """Looks up a callsign, in the same form as QRZ lookup results.
+
+        Returns None if the database doesn't cover the callsign, and an error result if
+        it does but the callsign isn't in it. This blocks, so run it in a thread."""
+        if not self.covers(callsign):
+            return None
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            if us_call_regex.fullmatch(callsign):
+                row = conn.execute(
+                    """SELECT hd.callsign, hd.status, hd.expired_date, en.name, en.first_name,
+                              en.last_name, en.suffix, en.street, en.city, en.state, en.zip,
+                              am.operator_class, am.previous_callsign, am.trustee_callsign
+                       FROM uls_hd hd
+                       LEFT JOIN uls_en en ON en.usi = hd.usi
+                       LEFT JOIN uls_am am ON am.usi = hd.usi
+                       WHERE hd.callsign = ?
+                       ORDER BY hd.status = 'A' DESC, hd.grant_date DESC,
+                                CAST(hd.usi AS INTEGER) DESC,
+                                en.entity_type = 'L' DESC, en.rowid, am.rowid
+                       LIMIT 1""",
+                    (callsign,),
+                ).fetchone()
+                if row is None:
+                    return {"error": f"{callsign} is not in the FCC license database."}
+                return uls_result(row)
+
+            row = conn.execute("SELECT * FROM ised WHERE callsign = ?", (callsign,)).fetchone()
+            if row is None:
+                return {"error": f"{callsign} is not in the ISED license database."}
+            return ised_result(row)
+
+
+def uls_result(row: sqlite3.Row) -> dict:
+    if row["first_name"]:
+        name = " ".join(p for p in (row["first_name"], row["last_name"], row["suffix"]) if p)
+    else:
+        name = row["name"]
+    address = ", ".join(p for p in (row["street"], row["city"], row["state"], row["zip"]) if p)
+    fields = {
+        "Name": name,
+        "Country": "United States",
+        "Address": address,
+        "License Class": uls_classes.get(row["operator_class"], row["operator_class"]),
+        "Status": uls_statuses.get(row["status"], row["status"]),
+        "Expires": row["expired_date"],
+        "Previous Callsign": row["previous_callsign"],
+        "Trustee": row["trustee_callsign"],
+    }
+    return {
+        "callsign": row["callsign"],
+        "url": f"https://www.qrz.com/db/{row['callsign']}",
+        "image": None,
+        "source": "FCC ULS",
+        "fields": [(k, v) for k, v in fields.items() if v],
+    }
+
+
+def ised_result(row: sqlite3.Row) -> dict:
+    name = " ".join(p for p in (row["first_name"], row["surname"]) if p) or row["club_name"]
+    address = ", ".join(
+        p for p in (row["address"], row["city"], row["province"], row["postal_code"]) if p
+    )
+    fields = {
+        "Name": name,
+        "Country": "Canada",
+        "Address": address,
+        "License Class": row["qualifications"],
+    }
+    return {
+        "callsign": row["callsign"],
+        "url": f"https://www.qrz.com/db/{row['callsign']}",
+        "image": None,
+        "source": "ISED",
+        "fields": [(k, v) for k, v in fields.items() if v],
+    }
+
+
+# --- Importing ---
+
+
+def open_db(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    # readers (the bot) keep working while an import runs
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def set_meta(conn: sqlite3.Connection, key: str, value: str) -> None:
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def iter_member_lines(source: Path, member: str, encoding: str) -> Iterator[str]:
+    """Streams the lines of a file from a directory or a zip file, case-insensitively."""
+    if source.is_dir():
+        for path in source.iterdir():
+            if path.name.lower() == member.lower():
+                with path.open(encoding=encoding, errors="replace", newline="") as file:
+                    yield from file
+                return
+        raise FileNotFoundError(f"{member} not found in {source}")
+    with zipfile.ZipFile(source) as archive:
+        for info in archive.infolist():
+            if Path(info.filename).name.lower() == member.lower():
+                with archive.open(info) as raw:
+                    yield from io.TextIOWrapper(raw, encoding=encoding, errors="replace", newline="")
+                return
+    raise FileNotFoundError(f"{member} not found in {source}")
+
+
+def member_date(source: Path, member: str) -> str:
+    """The ISO date a file in a directory or zip file was last modified.
+
+    The FCC's files don't carry their date inside them, and the daily ones are only
+    named after the day of the week, so this is how dumps are put in order."""
+    if source.is_dir():
+        for path in source.iterdir():
+            if path.name.lower() == member.lower():
+                stamp = datetime.fromtimestamp(path.stat().st_mtime, timezone.utc)
+                return stamp.date().isoformat()
+    else:
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if Path(info.filename).name.lower() == member.lower():
+                    year, month, day = info.date_time[:3]
+                    return f"{year:04d}-{month:02d}-{day:02d}"
+    raise FileNotFoundError(f"{member} not found in {source}")
+
+
+def newest_member_date(source: Path) -> str:
+    """The ISO date of the most recently modified file in a directory or zip file."""
+    if source.is_dir():
+        stamps = [path.stat().st_mtime for path in source.iterdir() if path.is_file()]
+        if stamps:
+            return datetime.fromtimestamp(max(stamps), timezone.utc).date().isoformat()
+    else:
+        with zipfile.ZipFile(source) as archive:
+            dates = [info.date_time[:3] for info in archive.infolist() if not info.is_dir()]
+        if dates:
+            year, month, day = max(dates)
+            return f"{year:04d}-{month:02d}-{day:02d}"
+    raise FileNotFoundError(f"{source} is empty")
+
+
+def uls_delta_date(source: Path) -> str:
+    """The date of a ULS daily file, from its HD.dat, or its newest file on days without one."""
+    try:
+        return member_date(source, "HD.dat")
+    except FileNotFoundError:
+        return newest_member_date(source)
+
+
+def uls_date(value: str) -> str:
+    """ULS dates are MM/DD/YYYY; store them as sortable ISO dates."""
+    if len(value) == 10 and value[2] == "/" and value[5] == "/":
+        return f"{value[6:]}-{value[:2]}-{value[3:5]}"
+    return value
+
+
+def iter_uls_rows(lines: Iterable[str], record_type: str, fields: tuple) -> Iterator[tuple]:
+    width = max(index for _, index in fields) + 1
+    for line in lines:
+        record = line.rstrip("\r\n").split("|")
+        # records with stray line breaks in them can't be trusted
+        if record[0] != record_type or len(record) < width:
+            continue
+        yield tuple(
+            uls_date(record[index]) if column in uls_date_columns else (record[index] or None)
+            for column, index in fields
+        )
+
+
+def stage_table(conn: sqlite3.Connection, table: str, columns: tuple[str, ...], rows: Iterable[tuple]) -> int:
+    """Loads `rows` in batches into a fresh staging table for `table`, with no indexes."""
+    staging = f"{table}_import"
+    conn.execute(f"DROP TABLE IF EXISTS {staging}")
+    conn.execute(f"CREATE TABLE {staging} ({', '.join(columns)})")
+    conn.commit()
+    insert = f"INSERT INTO {staging} VALUES ({', '.join('?' * len(columns))})"
+    count = 0
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        conn.executemany(insert, batch)
+        conn.commit()
+        count += len(batch)
+        print(f"\r{table}: {count} rows", end="", file=sys.stderr)
+    print(file=sys.stderr)
+    return count
+
+
+def swap_tables(conn: sqlite3.Connection, tables: dict[str, tuple[str, ...]]) -> None:
+    """Replaces each table with its staging table, indexed on the given columns.
+
+    Indexes are only built once everything is loaded, and every table is swapped in
+    the same transaction, so readers never see a mix of old and new tables."""
+    # sqlite3 doesn't open transactions for DDL by itself
+    conn.execute("BEGIN")
+    try:
+        for table, indexes in tables.items():
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.execute(f"ALTER TABLE {table}_import RENAME TO {table}")
+            for column in indexes:
+                conn.execute(f"CREATE INDEX {table}_{column}_idx ON {table} ({column})")
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def import_uls(db_path: Path, source: Path) -> None:
+    """Imports a full FCC ULS amateur dump (l_amat.zip, or a directory of its .dat files)."""
+    dump_date = member_date(source, "HD.dat")
+    conn = open_db(db_path)
+    try:
+        for record_type, (table, fields) in uls_tables.items():
+            rows = iter_uls_rows(
+                iter_member_lines(source, f"{record_type}.dat", "latin-1"), record_type, fields
+            )
+            columns = tuple(column for column, _ in fields)
+            stage_table(conn, table, columns, rows)
+        swap_tables(conn, uls_indexes)
+        with conn:
+            set_meta(conn, "uls_imported", datetime.now(timezone.utc).isoformat())
+            # daily files up to the dump's date are already in it
+            set_meta(conn, "uls_applied", dump_date)
+    finally:
+        conn.close()
+
+
+def apply_uls_delta(conn: sqlite3.Connection, source: Path, day: str) -> dict[str, int]:
+    """Applies one FCC ULS daily transaction file, all or nothing.
+
+    Every license in the file has its records for each record type replaced by the
+    file's, which carries its new status: cancelled and expired licenses are retired
+    in place, so lookups say so instead of showing them as active. Returns counts of
+    what changed, by table, plus how many licenses were retired."""
+    counts = {}
+    active = "SELECT 1 FROM uls_hd hd WHERE hd.usi = delta_usi.usi AND hd.status = 'A'"
+    conn.execute("BEGIN")
+    try:
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS delta_usi (usi TEXT PRIMARY KEY, was_active INTEGER)"
+        )
+        retired = 0
+        for record_type, (table, fields) in uls_tables.items():
+            try:
+                rows = list(
+                    iter_uls_rows(
+                        iter_member_lines(source, f"{record_type}.dat", "latin-1"),
+                        record_type,
+                        fields,
+                    )
+                )
+            except FileNotFoundError:
+                # days with nothing of a record type leave its file out
+                continue
+            conn.execute("DELETE FROM delta_usi")
+            conn.executemany("INSERT OR IGNORE INTO delta_usi (usi) VALUES (?)", ((row[0],) for row in rows))
+            if table == "uls_hd":
+                conn.execute(f"UPDATE delta_usi SET was_active = EXISTS ({active})")
+            conn.execute(f"DELETE FROM {table} WHERE usi IN (SELECT usi FROM delta_usi)")
+            conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(fields))})", rows)
+            if table == "uls_hd":
+                (retired,) = conn.execute(
+                    f"SELECT count(*) FROM delta_usi WHERE was_active AND NOT EXISTS ({active})"
+                ).fetchone()
+            counts[table] = len(rows)
+        counts["retired"] = retired
+        set_meta(conn, "uls_applied", day)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return counts
+
+
+def update_uls(db_path: Path, sources: Iterable[Path]) -> None:
+    """Applies FCC ULS daily transaction files in date order, skipping ones already in.
+
+    Each day is applied in its own transaction along with the record of it being
+    applied, so an interrupted update picks up where it stopped when run again."""
+    conn = open_db(db_path)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'uls_applied'").fetchone()
+        if row is None:
+            raise RuntimeError("No full ULS dump has been imported yet.")
+        applied = row[0]
+        days = []
+        for source in sources:
+            try:
+                days.append((uls_delta_date(source), str(source), source))
+            except FileNotFoundError:
+                print(f"{source}: no ULS files found, skipping", file=sys.stderr)
+        days.sort()
+        for day, _, source in days:
+            if day <= applied:
+                print(f"{source}: {day} already applied, skipping", file=sys.stderr)
+                continue
+            counts = apply_uls_delta(conn, source, day)
+            summary = ", ".join(f"{k}: {v}" for k, v in counts.items())
+            print(f"{source}: applied {day} ({summary})", file=sys.stderr)
+            applied = day
+    finally:
+        conn.close()
+
+
+def iter_ised_rows(lines: Iterable[str]) -> Iterator[tuple]:
+    lines = iter(lines)
+    next(lines, None)  # header
+    for line in lines:
+        record = line.rstrip("\r\n").split(";")
+        if len(record) < 13 or not record[0]:
+            continue
+        quals = ", ".join(q for q, flag in zip(ised_qualifications, record[7:12]) if flag.strip())
+        yield (
+            record[0].strip().upper(),
+            record[1].strip() or None,
+            record[2].strip() or None,
+            record[3].strip() or None,
+            record[4].strip() or None,
+            record[5].strip() or None,
+            record[6].strip() or None,
+            quals or None,
+            record[12].strip() or None,
+        )
+
+
+def import_ised(db_path: Path, source: Path) -> None:
+    """Imports ISED's amateur list (amateur_delim.zip, amateur_delim.txt or its directory)."""
+    if source.suffix.lower() == ".txt":
+        source_dir, member = source.parent, source.name
+    else:
+        source_dir, member = source, "amateur_delim.txt"
+    conn = open_db(db_path)
+    try:
+        rows = iter_ised_rows(iter_member_lines(source_dir, member, "latin-1"))
+        stage_table(conn, "ised", ised_columns, rows)
+        swap_tables(conn, {"ised": ("callsign",)})
+        with conn:
+            set_meta(conn, "ised_imported", datetime.now(timezone.utc).isoformat())
+    finally:
+        conn.close()
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m utils.callsign_db",
+        description="Imports license dumps into qrm's local callsign database.",
+    )
+    parser.add_argument("--db", type=Path, default=default_path, help=f"database file (default: {default_path})")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("uls", help="import a full FCC ULS amateur dump").add_argument("source", type=Path)
+    sub.add_parser("uls-daily", help="apply FCC ULS daily transaction files").add_argument(
+        "sources", type=Path, nargs="+"
+    )
+    sub.add_parser("ised", help="import the ISED amateur list").add_argument("source", type=Path)
+    args = parser.parse_args(argv)
+
+    if args.command == "uls":
+        import_uls(args.db, args.source)
+    elif args.command == "uls-daily":
+        update_uls(args.db, args.sources)
+    elif args.command == "ised":
+        import_ised(args.db, args.source)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Shared outbound HTTP clients for qrm.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+import aiohttp
+import httpx
+
+try:
+    import h2  # noqa: F401
+    http2_available = True
+except ImportError:
+    http2_available = False
+
+
+class HttpClients:
+    """The bot's HTTP clients, shared by every extension.
+
+    One aiohttp session and one httpx client, each with a single connection pool, so
+    connections (and their TLS handshakes) are reused across extensions and reloads.
+    Extensions must not close them; `close()` is called when the bot shuts down."""
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 16,
+        keepalive_timeout: float = 30.0,
+        dns_cache_ttl: int = 300,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=dns_cache_ttl,
+        )
+        self.session = aiohttp.ClientSession(connector=self.connector)
+        self.httpx = httpx.AsyncClient(
+            http2=http2_available,
+            limits=httpx.Limits(
+                max_connections=limit,
+                max_keepalive_connections=limit_per_host,
+                keepalive_expiry=keepalive_timeout,
+            ),
+        )
+
+    def stats(self) -> dict:
+        """Reports how saturated the connection pools are.
+
+        Neither library exposes this publicly, so missing internals just read as 0."""
+        acquired_per_host = getattr(self.connector, "_acquired_per_host", {})
+        waiters = getattr(self.connector, "_waiters", {})
+        hosts = {
+            f"{key.host}:{key.port}": len(conns)
+            for key, conns in acquired_per_host.items()
+            if conns
+        }
+        pool = getattr(getattr(self.httpx, "_transport", None), "_pool", None)
+        httpx_conns = list(getattr(pool, "connections", []))
+        return {
+            "aiohttp_in_use": len(getattr(self.connector, "_acquired", ())),
+            "aiohttp_waiting": sum(len(w) for w in waiters.values()),
+            "aiohttp_hosts": hosts,
+            "httpx_open": len(httpx_conns),
+            "httpx_idle": sum(1 for c in httpx_conns if c.is_idle()),
+            "httpx_http2": http2_available,
+        }
+
+    async def close(self) -> None:
+        await self.session.close()
+        await self.httpx.aclose()
+
+
+async def new_clients(*args, **kwargs) -> HttpClients:
+    """aiohttp wants its sessions created from a coroutine."""
+    return HttpClients(*args, **kwargs)
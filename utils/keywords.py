@@ -0,0 +1,74 @@
+"""
+Multi-keyword matching for qrm.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+from collections import deque
+from typing import Hashable, Iterable, Mapping
+
+
+class KeywordMatcher:
+    """Finds which groups of keywords appear in a text, in a single pass over it.
+
+    Built once from `{tag: (keyword, ...)}` as an Aho–Corasick automaton, so matching
+    costs the length of the text no matter how many keywords there are. Keywords match
+    anywhere in the text, like `keyword in text` would."""
+
+    def __init__(self, groups: Mapping[Hashable, Iterable[str]]):
+        # state 0 is the root; each state has its transitions, fail link and output tags
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[frozenset] = [frozenset()]
+        # tags in configuration order, so results come out in a stable order
+        self.tags = list(groups)
+
+        outputs: list[set] = [set()]
+        for tag, keywords in groups.items():
+            for keyword in keywords:
+                if not keyword:
+                    continue
+                state = 0
+                for char in keyword:
+                    nxt = self._goto[state].get(char)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto[state][char] = nxt
+                        self._goto.append({})
+                        self._fail.append(0)
+                        outputs.append(set())
+                    state = nxt
+                outputs[state].add(tag)
+
+        # breadth-first, so a state's fail link is always finished before its children
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                outputs[nxt] |= outputs[self._fail[nxt]]
+                queue.append(nxt)
+        self._out = [frozenset(o) for o in outputs]
+
+    def __bool__(self) -> bool:
+        return len(self._goto) > 1
+
+    def match(self, text: str) -> list:
+        """Returns the tags with at least one keyword in `text`, in configuration order."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found: set[str] = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+                if len(found) == len(self.tags):
+                    break
+        return [tag for tag in self.tags if tag in found]
@@ -0,0 +1,31 @@
+"""
+Deferred imports for heavy dependencies.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+import importlib
+import importlib.util
+import sys
+from types import ModuleType
+
+import data.options as opt
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Imports a module, or with `lazy_imports` enabled, defers it until an attribute is used.
+
+    Anything done with the module at import time (`from x import y`, annotations,
+    base classes) loads it right away, so only use it through attribute access."""
+    if not opt.lazy_imports or name in sys.modules:
+        return importlib.import_module(name)
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
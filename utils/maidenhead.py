@@ -0,0 +1,105 @@
+"""
+Batch Maidenhead grid locator calculations for qrm.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+
+The same conversions as gridtools, done on whole arrays at once with NumPy.
+"""
+
+import re
+from typing import Sequence, Tuple
+
+import numpy as np
+from numpy.typing import ArrayLike
+
+
+# any valid 2-8 character grid, as in gridtools
+grid_regex = re.compile(r"[A-R]{2}(?:\d{2}(?:[A-X]{2}(?:\d{2})?)?)?", re.IGNORECASE)
+
+earth_radius = 6371  # km, as in gridtools
+
+# (lon, lat) size in degrees of each pair: field, square, subsquare, extended square
+pair_sizes = ((20, 10), (2, 1), (5 / 60, 2.5 / 60), (30 / 3600, 15 / 3600))
+# the character each pair counts up from
+pair_zeros = (ord("A"), ord("0"), ord("A"), ord("0"))
+# extended squares per degree
+esq_per_lon = 120
+esq_per_lat = 240
+# how many extended squares each pair steps by, and how many steps it has
+pair_steps = (2400, 240, 10, 1)
+pair_counts = (18, 10, 24, 10)
+
+
+def decode(grids: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the latitude and longitude of the centre of each grid locator.
+
+    Raises ValueError if any of them isn't a valid 2, 4, 6 or 8 character locator."""
+    for grid in grids:
+        if not grid_regex.fullmatch(grid):
+            raise ValueError(f"Invalid grid locator: {grid}")
+    n = len(grids)
+    lengths = np.fromiter((len(g) for g in grids), dtype=np.int64, count=n)
+    # pad so every locator is 8 characters, the padding is masked out below
+    chars = np.frombuffer(
+        "".join(g.upper().ljust(8, "0") for g in grids).encode("ascii"), dtype=np.uint8
+    ).reshape(n, 8).astype(np.float64)
+
+    lon = np.full(n, -180.0)
+    lat = np.full(n, -90.0)
+    half_lon = np.zeros(n)
+    half_lat = np.zeros(n)
+    for pair, ((size_lon, size_lat), zero) in enumerate(zip(pair_sizes, pair_zeros)):
+        present = lengths > pair * 2
+        lon += np.where(present, (chars[:, pair * 2] - zero) * size_lon, 0)
+        lat += np.where(present, (chars[:, pair * 2 + 1] - zero) * size_lat, 0)
+        # the last pair decides how far the centre is
+        half_lon = np.where(present, size_lon / 2, half_lon)
+        half_lat = np.where(present, size_lat / 2, half_lat)
+    return lat + half_lat, lon + half_lon
+
+
+def encode(lat: ArrayLike, lon: ArrayLike, length: int = 6) -> list[str]:
+    """Finds the grid locator, `length` characters long, containing each coordinate pair."""
+    if length not in (2, 4, 6, 8):
+        raise ValueError("Grid locators are 2, 4, 6 or 8 characters long.")
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if np.any(np.abs(lat) > 90) or np.any(np.abs(lon) > 180):
+        raise ValueError("Latitudes must be between -90 and 90, and longitudes between -180 and 180.")
+
+    # count in extended squares, so every pair is a whole division; the north pole and
+    # antimeridian go in the last grid before them
+    lon_esq = np.minimum(np.floor((lon + 180) * esq_per_lon), 360 * esq_per_lon - 1).astype(np.int64)
+    lat_esq = np.minimum(np.floor((lat + 90) * esq_per_lat), 180 * esq_per_lat - 1).astype(np.int64)
+    chars = np.empty((lon_esq.size, length), dtype=np.uint8)
+    for pair in range(length // 2):
+        # subsquares are written in lowercase
+        zero = ord("a") if pair == 2 else pair_zeros[pair]
+        chars[:, pair * 2] = lon_esq // pair_steps[pair] % pair_counts[pair] + zero
+        chars[:, pair * 2 + 1] = lat_esq // pair_steps[pair] % pair_counts[pair] + zero
+    data = chars.tobytes().decode("ascii")
+    return [data[i:i + length] for i in range(0, len(data), length)]
+
+
+def distance_bearing(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the great circle distance (km) and initial bearing (°) from points 1 to points 2.
+
+    The arrays are broadcast against each other, so one origin can be given as scalars,
+    or a full matrix made with `lat1[:, None]` and `lon1[:, None]`."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(np.asarray(lon2) - np.asarray(lon1))
+
+    # haversine
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    dist = 2 * earth_radius * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    y = np.sin(d_lambda) * np.cos(phi2)
+    x = np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(d_lambda)
+    bearing = (np.degrees(np.arctan2(y, x)) + 360) % 360
+    return dist, bearing
@@ -0,0 +1,223 @@
+"""
+METAR and TAF decoding for qrm.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+import re
+from datetime import datetime, timedelta, timezone
+from fractions import Fraction
+from typing import Iterable, Iterator, Optional
+
+
+time_regex = re.compile(r"(\d{2})(\d{2})(\d{2})Z")
+wind_regex = re.compile(r"(\d{3}|VRB)(\d{2,3})(?:G(\d{2,3}))?(KT|MPS|KMH)")
+statute_vis_regex = re.compile(r"([MP])?(\d+(?:/\d+)?)SM")
+metric_vis_regex = re.compile(r"(\d{4})(?:NDV)?")
+cloud_regex = re.compile(r"(FEW|SCT|BKN|OVC|VV)(\d{3}|///)")
+temp_regex = re.compile(r"(M?\d{2})/(M?\d{2})?")
+altimeter_regex = re.compile(r"([AQ])(\d{4})")
+
+# Change groups end a TAF's initial conditions
+taf_change_groups = ("FM", "TEMPO", "BECMG", "PROB")
+report_prefixes = {"METAR", "SPECI", "TAF", "AMD", "COR", "AUTO"}
+
+knots_per_unit = {"KT": 1.0, "MPS": 1.943844, "KMH": 0.539957}
+metres_per_mile = 1609.344
+hpa_per_inhg = 33.8639
+
+
+class Observation:
+    """The useful parts of one METAR, or of a TAF's initial conditions.
+
+    Anything the report doesn't give is None. Wind is in knots, visibility in
+    statute miles, ceiling in feet, temperatures in °C and altimeter in inHg."""
+
+    __slots__ = (
+        "station",
+        "time",
+        "wind_dir",
+        "wind_speed",
+        "wind_gust",
+        "visibility",
+        "ceiling",
+        "temperature",
+        "dewpoint",
+        "altimeter",
+    )
+
+    def __init__(self, station: str, time: Optional[datetime]):
+        self.station = station
+        self.time = time
+        self.wind_dir: Optional[int] = None  # None with a speed means variable
+        self.wind_speed: Optional[int] = None
+        self.wind_gust: Optional[int] = None
+        self.visibility: Optional[float] = None
+        self.ceiling: Optional[int] = None
+        self.temperature: Optional[int] = None
+        self.dewpoint: Optional[int] = None
+        self.altimeter: Optional[float] = None
+
+    @property
+    def category(self) -> Optional[str]:
+        """The FAA flight category, if there is enough to tell."""
+        if self.visibility is None and self.ceiling is None:
+            return None
+        vis = self.visibility if self.visibility is not None else float("inf")
+        ceiling = self.ceiling if self.ceiling is not None else float("inf")
+        if ceiling < 500 or vis < 1:
+            return "LIFR"
+        if ceiling < 1000 or vis < 3:
+            return "IFR"
+        if ceiling <= 3000 or vis <= 5:
+            return "MVFR"
+        return "VFR"
+
+    def format_wind(self) -> str:
+        if self.wind_speed is None:
+            return "-"
+        if self.wind_speed == 0:
+            return "Calm"
+        direction = "VRB" if self.wind_dir is None else f"{self.wind_dir:03d}°"
+        gust = f"G{self.wind_gust}" if self.wind_gust else ""
+        return f"{direction} {self.wind_speed}{gust} kt"
+
+    def format_visibility(self) -> str:
+        if self.visibility is None:
+            return "-"
+        if self.visibility >= 10:
+            return "10+ SM"
+        vis = Fraction(self.visibility).limit_denominator(16)
+        if abs(vis - self.visibility) > 1e-6:
+            # converted from metres
+            return f"{self.visibility:.1f} SM"
+        whole, part = divmod(vis, 1)
+        if not part:
+            return f"{whole} SM"
+        return f"{whole} {part} SM" if whole else f"{part} SM"
+
+    def format_ceiling(self) -> str:
+        if self.ceiling is None:
+            return "None" if self.visibility is not None else "-"
+        return f"{self.ceiling} ft"
+
+    def format_temperature(self) -> str:
+        if self.temperature is None:
+            return "-"
+        dew = f"{self.dewpoint}" if self.dewpoint is not None else "-"
+        return f"{self.temperature}/{dew} °C"
+
+    def format_altimeter(self) -> str:
+        if self.altimeter is None:
+            return "-"
+        return f"{self.altimeter:.2f} inHg ({self.altimeter * hpa_per_inhg:.0f} hPa)"
+
+
+def parse_time(match: re.Match, now: datetime) -> Optional[datetime]:
+    """Turns a DDHHMMZ group into a datetime, in this month or the last one."""
+    day, hour, minute = (int(g) for g in match.groups())
+    year, month = now.year, now.month
+    for _ in range(2):
+        try:
+            when = datetime(year, month, day, hour, minute, tzinfo=timezone.utc)
+        except ValueError:
+            when = None
+        if when is not None and when <= now + timedelta(hours=1):
+            return when
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return None
+
+
+def report_time(line: str, now: datetime) -> Optional[datetime]:
+    """Finds the time of the report on a line, from its first DDHHMMZ group."""
+    for token in line.split():
+        match = time_regex.fullmatch(token)
+        if match is not None:
+            return parse_time(match, now)
+    return None
+
+
+def parse_report(line: str, now: Optional[datetime] = None) -> Optional[Observation]:
+    """Decodes a single METAR or TAF line. Returns None if it isn't one."""
+    if now is None:
+        now = datetime.now(timezone.utc)
+    tokens = line.split()
+    i = 0
+    while i < len(tokens) and tokens[i] in report_prefixes:
+        i += 1
+    if i >= len(tokens) or not tokens[i].isalnum():
+        return None
+    station = tokens[i]
+    i += 1
+    time_match = time_regex.fullmatch(tokens[i]) if i < len(tokens) else None
+    if time_match is None:
+        return None
+    obs = Observation(station, parse_time(time_match, now))
+    i += 1
+
+    tokens = tokens[i:]
+    for i, token in enumerate(tokens):
+        if token == "RMK" or token.startswith(taf_change_groups):
+            break
+        if obs.wind_speed is None and (match := wind_regex.fullmatch(token)):
+            factor = knots_per_unit[match.group(4)]
+            obs.wind_dir = None if match.group(1) == "VRB" else int(match.group(1))
+            obs.wind_speed = round(int(match.group(2)) * factor)
+            if match.group(3):
+                obs.wind_gust = round(int(match.group(3)) * factor)
+        elif token == "CAVOK":
+            obs.visibility = 10.0
+        elif obs.visibility is None and (match := statute_vis_regex.fullmatch(token)):
+            vis = float(Fraction(match.group(2)))
+            # "1 1/2SM" comes as two tokens
+            if "/" in match.group(2) and i > 0 and tokens[i - 1].isdigit():
+                vis += int(tokens[i - 1])
+            obs.visibility = vis
+        elif obs.visibility is None and (match := metric_vis_regex.fullmatch(token)):
+            obs.visibility = min(int(match.group(1)) / metres_per_mile, 10.0)
+        elif match := cloud_regex.fullmatch(token):
+            if match.group(1) in ("BKN", "OVC", "VV") and match.group(2) != "///":
+                height = int(match.group(2)) * 100
+                if obs.ceiling is None or height < obs.ceiling:
+                    obs.ceiling = height
+        elif obs.temperature is None and (match := temp_regex.fullmatch(token)):
+            obs.temperature = parse_temp(match.group(1))
+            if match.group(2):
+                obs.dewpoint = parse_temp(match.group(2))
+        elif obs.altimeter is None and (match := altimeter_regex.fullmatch(token)):
+            if match.group(1) == "A":
+                obs.altimeter = int(match.group(2)) / 100
+            else:
+                obs.altimeter = int(match.group(2)) / hpa_per_inhg
+    return obs
+
+
+def parse_temp(value: str) -> int:
+    return -int(value[1:]) if value.startswith("M") else int(value)
+
+
+def iter_reports(lines: Iterable[str], now: Optional[datetime] = None) -> Iterator[Observation]:
+    """Decodes reports one line at a time, skipping lines that aren't reports."""
+    if now is None:
+        now = datetime.now(timezone.utc)
+    for line in lines:
+        if line[:1].isspace():
+            continue
+        obs = parse_report(line, now)
+        if obs is not None:
+            yield obs
+
+
+def trend_table(observations: Iterable[Observation]) -> str:
+    """Formats observations as a fixed-width table, one row each."""
+    rows = [f"{'Time':<7} {'Cat':<4} {'Wind':<13} {'Vis':<8} {'Ceiling':<8} T/Td"]
+    for obs in observations:
+        when = obs.time.strftime("%d%H%MZ") if obs.time else "-"
+        temp = obs.format_temperature().removesuffix(" °C")
+        rows.append(
+            f"{when:<7} {obs.category or '-':<4} {obs.format_wind():<13} "
+            f"{obs.format_visibility():<8} {obs.format_ceiling():<8} {temp}"
+        )
+    return "\n".join(rows)
@@ -0,0 +1,53 @@
+"""
+Lightweight runtime metrics for qrm.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+import math
+from collections import deque
+
+
+class LatencyWindow:
+    """Keeps the most recent durations (in seconds) and summarises them."""
+
+    def __init__(self, size: int = 256):
+        self._samples: deque[float] = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds: float) -> None:
+        """Records a duration."""
+        self._samples.append(seconds)
+        self.count += 1
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, pct: float) -> float:
+        """Nearest-rank percentile of the recorded durations, 0 if there are none."""
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        rank = max(1, math.ceil(pct / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+    @property
+    def mean(self) -> float:
+        return sum(self._samples) / len(self._samples) if self._samples else 0.0
+
+    @property
+    def max(self) -> float:
+        return max(self._samples, default=0.0)
+
+    def summary(self) -> str:
+        """Formats the window as a short human-readable string."""
+        if not self._samples:
+            return "No samples yet"
+        return (
+            f"p50 {self.percentile(50) * 1000:.0f} ms, "
+            f"p95 {self.percentile(95) * 1000:.0f} ms, "
+            f"max {self.max * 1000:.0f} ms "
+            f"(last {len(self._samples)} of {self.count})"
+        )
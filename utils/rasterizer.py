@@ -0,0 +1,120 @@
+"""
+Off-loop SVG rasterization for qrm.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils.metrics import LatencyWindow
+
+
+class RasterizerBusy(Exception):
+    """Raised when the rasterization queue is full."""
+
+
+class RasterizerTimeout(Exception):
+    """Raised when a render takes longer than the configured timeout."""
+
+
+def _svg_to_png(svg: bytes) -> tuple[bytes, float]:
+    """Runs in a worker process. cairosvg is only ever imported there."""
+    import cairosvg
+
+    start = time.perf_counter()
+    png = cairosvg.svg2png(bytestring=svg)
+    return png, time.perf_counter() - start
+
+
+class SvgRasterizer:
+    """Renders SVG documents to PNG in a pool of worker processes.
+
+    At most `workers + max_queue` jobs are admitted at once; anything beyond
+    that is rejected with `RasterizerBusy` instead of piling up behind a slow render.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 8, timeout: float = 30.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = self._new_executor()
+        self.restarts = 0
+
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.render_times = LatencyWindow()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # fork explicitly: spawn/forkserver would re-execute main.py in the children
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("fork")
+        )
+        # Start the workers now; at startup, while the process is still single-threaded.
+        executor.submit(int)
+        return executor
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        """Replaces the pool after a worker died, which leaves it unusable."""
+        if self._executor is not broken:
+            # another job already replaced it
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._new_executor()
+        self.restarts += 1
+
+    @property
+    def queue_depth(self) -> int:
+        """Jobs admitted but waiting for a free worker."""
+        return max(0, self.in_flight - self.workers)
+
+    def _release(self, _: Future) -> None:
+        self.in_flight -= 1
+
+    async def render(self, svg: bytes) -> bytes:
+        """Renders an SVG document to PNG bytes without blocking the event loop."""
+        if self.in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise RasterizerBusy("Too many images are being rendered, try again later.")
+
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            job = executor.submit(_svg_to_png, svg)
+        except BrokenProcessPool:
+            self._restart(executor)
+            executor = self._executor
+            job = executor.submit(_svg_to_png, svg)
+        self.in_flight += 1
+        # A job that timed out keeps its worker busy until it finishes, so only
+        # release its slot once the worker is actually done with it.
+        job.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release, f))
+
+        try:
+            png, elapsed = await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise RasterizerTimeout(f"Rendering took longer than {self.timeout:.0f}s.") from None
+        except BrokenProcessPool:
+            self.failed += 1
+            self._restart(executor)
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+
+        self.completed += 1
+        self.render_times.add(elapsed)
+        return png
+
+    def shutdown(self) -> None:
+        """Stops the worker processes."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
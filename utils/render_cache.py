@@ -0,0 +1,145 @@
+"""
+Content-addressed cache for rendered images.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+
+class RenderCache:
+    """Rendered output keyed by a hash of everything that went into rendering it.
+
+    Recently used entries are kept in memory, bounded by their total size. Every entry
+    is also written to `path`, which is trimmed back to `max_disk` bytes by dropping
+    the least recently used files (by mtime) when it grows past it."""
+
+    def __init__(
+        self,
+        path: Path,
+        max_memory: int = 16 * 1024**2,
+        max_disk: int = 256 * 1024**2,
+        suffix: str = ".png",
+    ):
+        self.path = path
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memory_size = 0
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        # writes happen in worker threads; guards disk_size and eviction
+        self._disk_lock = threading.Lock()
+        self.disk_size = sum(f.stat().st_size for f in self.path.glob("*" + suffix))
+
+    @staticmethod
+    def key(*parts: Union[str, bytes, int]) -> str:
+        """Hashes the inputs of a render into a cache key."""
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, int):
+                part = str(part)
+            if isinstance(part, str):
+                part = part.encode()
+            # length-prefixed, so ("ab", "c") and ("a", "bc") differ
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return data
+
+        data = await asyncio.to_thread(self._read, key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, data)
+        return data
+
+    async def put(self, key: str, data: bytes) -> None:
+        self._remember(key, data)
+        await asyncio.to_thread(self._write, key, data)
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_memory:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self.memory_size -= len(old)
+        self._memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.max_memory:
+            _, evicted = self._memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def _file(self, key: str) -> Path:
+        return self.path / (key + self.suffix)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        file = self._file(key)
+        try:
+            data = file.read_bytes()
+            # mtime doubles as the last use for disk eviction
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _write(self, key: str, data: bytes) -> None:
+        file = self._file(key)
+        if file.exists():
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with self._disk_lock:
+                # another thread may have written the same key since the check above
+                try:
+                    replaced = file.stat().st_size
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(tmp, file)
+                self.disk_size += len(data) - replaced
+                if self.disk_size > self.max_disk:
+                    self._evict()
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _evict(self) -> None:
+        """Drops the least recently used files. Call with `_disk_lock` held."""
+        files = []
+        for f in self.path.glob("*" + self.suffix):
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, f))
+        self.disk_size = sum(size for _, size, _ in files)
+        # trim a bit below the limit so every new entry doesn't rescan the directory
+        target = self.max_disk * 0.9
+        for _, size, f in sorted(files):
+            if self.disk_size <= target:
+                break
+            f.unlink(missing_ok=True)
+            self.disk_size -= size
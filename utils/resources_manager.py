@@ -6,34 +6,69 @@ Copyright (C) 2021-2023 classabbyamp, 0x5c
 SPDX-License-Identifier: LiLiQ-Rplus-1.1
 """
 
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 import httpx
 
-from utils.resources_models import Index
+from utils.resources_models import File, Index
+
+
+# The index doesn't say which algorithm made the hashes, so guess from the digest length
+hash_algorithms = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
 
 
 class ResourcesManager:
 
-    def __init__(self, basedir: Path, url: str, versions: dict):
+    def __init__(self, basedir: Path, url: str, versions: dict, max_connections: int = 8):
         self.basedir = basedir
         self.url = url
         self.versions = versions
+        self.max_connections = max_connections
         self.index: Index = self.sync_start(basedir)
 
     def parse_index(self, index: str):
         """Parses the index."""
         return Index.model_validate_json(index)
 
-    def sync_fetch(self, filepath: str):
+    def sync_fetch(self, filepath: str, client: Optional[httpx.Client] = None):
         """Fetches files in sync mode."""
         self.print_msg(f"Fetching {filepath}", "sync")
-        resp = httpx.get(self.url + filepath)
+        resp = client.get(self.url + filepath) if client else httpx.get(self.url + filepath)
         resp.raise_for_status()
         r = resp.content
         resp.close()
         return r
 
+    def sync_file(self, client: httpx.Client, basedir: Path, file: File) -> None:
+        """Downloads a file unless the local copy matches its hash. Replaces the file atomically."""
+        path = basedir / file.filename
+        if file_hash(path, file.hash) == file.hash.lower():
+            return
+        tmp_path = path.with_name(path.name + ".tmp")
+        try:
+            content = self.sync_fetch(file.filename, client)
+            # None if the index's hash isn't one we know how to check
+            digest = file_hash_bytes(content, file.hash)
+            if digest is not None and digest != file.hash.lower():
+                raise ValueError("hash mismatch")
+            with tmp_path.open("wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except (httpx.HTTPError, OSError, ValueError) as ex:
+            ex_cls = ex.__class__.__name__
+            self.print_msg(
+                f"There was an issue fetching {file.filename}: {ex_cls}: {ex}",
+                "sync",
+            )
+            tmp_path.unlink(missing_ok=True)
+            if not path.exists():
+                raise SystemExit(1)
+            self.print_msg("Old file exists, using it", "fallback")
+
     def sync_start(self, basedir: Path) -> Index:
         """Takes cares of constructing the local resources repository and initialising the RM."""
         self.print_msg("Initialising ResourceManager", "sync")
@@ -41,8 +76,9 @@ class ResourcesManager:
         try:
             raw = self.sync_fetch("index.json")
             new_index: Index = self.parse_index(raw)
-            with (basedir / "index.json").open("wb") as file:
+            with (basedir / "index.json.tmp").open("wb") as file:
                 file.write(raw)
+            os.replace(basedir / "index.json.tmp", basedir / "index.json")
         except (httpx.RequestError, OSError) as ex:
             self.print_msg(
                 f"There was an issue fetching the index: {ex.__class__.__name__}: {ex}",
@@ -61,20 +97,12 @@ class ResourcesManager:
                             raise SystemExit(1)
                 return old_index
             raise SystemExit(1)
-        for res, ver in self.versions.items():
-            for file in new_index[res][ver]:
-                try:
-                    with (basedir / file.filename).open("wb") as f:
-                        f.write(self.sync_fetch(file.filename))
-                except (httpx.RequestError, OSError) as ex:
-                    ex_cls = ex.__class__.__name__
-                    self.print_msg(
-                        f"There was an issue fetching {file.filename}: {ex_cls}: {ex}",
-                        "sync",
-                    )
-                    if not (basedir / file.filename).exists():
-                        raise SystemExit(1)
-                    self.print_msg("Old file exists, using it", "fallback")
+        files = [file for res, ver in self.versions.items() for file in new_index[res][ver]]
+        limits = httpx.Limits(max_connections=self.max_connections)
+        with httpx.Client(limits=limits) as client:
+            with ThreadPoolExecutor(max_workers=self.max_connections) as pool:
+                # list() re-raises the first SystemExit from the workers
+                list(pool.map(lambda file: self.sync_file(client, basedir, file), files))
         return new_index
 
     def ensure_dir(self, basedir: Path) -> bool:
@@ -87,10 +115,30 @@ class ResourcesManager:
             return True
         return False
 
-    def print_msg(self, msg: str, mode: str = None):
+    def print_msg(self, msg: str, mode: Optional[str] = None):
         """Formats and prints messages for the resources manager."""
         message = "RM: "
         message += msg
         if mode:
             message += f" ({mode})"
         print(message)
+
+
+def file_hash(path: Path, expected: str) -> Optional[str]:
+    """Hashes a file with the algorithm matching `expected`. None if the file is missing."""
+    algorithm = hash_algorithms.get(len(expected))
+    if algorithm is None:
+        return None
+    try:
+        with path.open("rb") as f:
+            return hashlib.file_digest(f, algorithm).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def file_hash_bytes(content: bytes, expected: str) -> Optional[str]:
+    """Hashes bytes with the algorithm matching `expected`. None if it can't be guessed."""
+    algorithm = hash_algorithms.get(len(expected))
+    if algorithm is None:
+        return None
+    return hashlib.new(algorithm, content).hexdigest()
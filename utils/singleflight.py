@@ -0,0 +1,45 @@
+"""
+Request coalescing for qrm.
+---
+Copyright (C) 2026 jaytotheay
+
+SPDX-License-Identifier: LiLiQ-Rplus-1.1
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Deduplicates identical concurrent calls.
+
+    While a call for a key is in flight, every other caller with the same key awaits
+    its result instead of starting a new one. Nothing is kept once the call is done.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """Awaits `func()`, or the identical call already running for `key`."""
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(func())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._forget(key, f))
+        # a cancelled caller must not cancel the call for everyone else
+        return await asyncio.shield(fut)
+
+    def _forget(self, key: Hashable, fut: asyncio.Future) -> None:
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        # mark the exception as retrieved in case every caller went away
+        if not fut.cancelled():
+            fut.exception()